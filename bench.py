@@ -0,0 +1,333 @@
+from __future__ import print_function
+
+import bisect
+from collections import Counter
+import pickle
+import random
+import sys
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from local import ENGINE_ARRAY, ENGINE_HEAP, ENGINE_STREAM_SUMMARY, \
+    TopTalkerTracker
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+BENCH_TABLE = 'bench:top_talkers'
+
+
+def zipf_stream(rng, num_adds, num_keys, skew):
+    """
+    Keys 0..num_keys - 1, key i drawn with probability proportional to
+    1 / (i + 1) ** skew.
+    """
+    cumulative = []
+    total = 0.0
+    for i in range(num_keys):
+        total += 1.0 / (i + 1) ** skew
+        cumulative.append(total)
+    return [bisect.bisect_left(cumulative, rng.random() * total)
+            for i in range(num_adds)]
+
+
+def uniform_stream(rng, num_adds, num_keys):
+    return [rng.randrange(num_keys) for i in range(num_adds)]
+
+
+def bursty_stream(rng, num_adds, num_keys, num_heavy=10, heavy_share=0.3,
+                  phase_adds=10000):
+    """
+    Uniform background traffic, plus num_heavy heavy hitters taking
+    heavy_share of it.  Every phase_adds adds the heavy hitters are replaced by
+    fresh keys, so yesterday's heavy hitters have to age out of the table.
+    """
+    keys = []
+    heavy = []
+    next_heavy = num_keys
+    for i in range(num_adds):
+        if not i % phase_adds:
+            heavy = list(range(next_heavy, next_heavy + num_heavy))
+            next_heavy += num_heavy
+        if rng.random() < heavy_share:
+            keys.append(rng.choice(heavy))
+        else:
+            keys.append(rng.randrange(num_keys))
+    return keys
+
+
+def workloads(rng, num_adds, num_keys):
+    """
+    -> list of (name, list of int keys)
+    """
+    return [
+        ('zipf-0.8', zipf_stream(rng, num_adds, num_keys, 0.8)),
+        ('zipf-1.1', zipf_stream(rng, num_adds, num_keys, 1.1)),
+        ('zipf-1.5', zipf_stream(rng, num_adds, num_keys, 1.5)),
+        ('uniform', uniform_stream(rng, num_adds, num_keys)),
+        ('bursty', bursty_stream(rng, num_adds, num_keys)),
+    ]
+
+
+def text(key):
+    if isinstance(key, bytes):
+        return key.decode('utf-8')
+    return key
+
+
+class LocalBackend(object):
+    def __init__(self, size, engine):
+        self.name = 'local-' + engine
+        self.size = size
+        self.engine = engine
+        self.tracker = TopTalkerTracker(size, engine)
+
+    def clear(self):
+        self.tracker = TopTalkerTracker(self.size, self.engine)
+
+    def add(self, key):
+        self.tracker.add(key, None)
+
+    def top_n(self, n):
+        return [(a.key, a.count) for a in self.tracker.top_n(n)]
+
+    def memory(self, keys):
+        """
+        Bytes held after replaying keys into a fresh tracker, keys themselves
+        included (each is added as a fresh copy, so tracemalloc sees the
+        tracked ones allocated), as Redis's MEMORY USAGE counts them too.
+        None without tracemalloc.
+        """
+        if tracemalloc is None:
+            return None
+
+        tracemalloc.start()
+        t = TopTalkerTracker(self.size, self.engine)
+        for key in keys:
+            t.add(pickle.loads(pickle.dumps(key)), None)
+        num_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return num_bytes
+
+
+class RedisBackend(object):
+    """
+    Base for the Redis backends: memory is MEMORY USAGE of the table.
+    """
+
+    table = BENCH_TABLE
+
+    def memory(self, keys):
+        try:
+            return self.client.execute_command('MEMORY', 'USAGE', self.table)
+        except Exception:
+            return None
+
+
+class WithRedisBackend(RedisBackend):
+    table = 'top_talkers'
+
+    def __init__(self, size, redis_host, redis_port):
+        from with_redis import RedisTopTalkerTracker
+        self.name = 'with_redis'
+        self.tracker = RedisTopTalkerTracker(size, redis_host, redis_port)
+        self.client = self.tracker.client
+
+    def clear(self):
+        self.tracker.clear()
+
+    def add(self, key):
+        self.tracker.add(key)
+
+    def top_n(self, n):
+        return [(text(key), count)
+                for key, count in self.tracker.top_n_keys_counts(n)]
+
+
+class TransactBackend(RedisBackend):
+    def __init__(self, size, redis_host, redis_port, mode):
+        from with_redis_transact import RedisTopTalkerTracker
+        self.name = 'transact-' + mode
+        self.size = size
+        self.tracker = RedisTopTalkerTracker(redis_host, redis_port, mode)
+        self.client = self.tracker.client
+
+    def clear(self):
+        self.tracker.clear(self.table)
+
+    def add(self, key):
+        self.tracker.add(self.table, self.size, key)
+
+    def top_n(self, n):
+        return [(text(key), count) for key, count in
+                self.tracker.top_n_keys_counts(self.table, self.size, n)]
+
+
+class LuaBackend(RedisBackend):
+    def __init__(self, size, redis_host, redis_port):
+        from redis_lua import TopTalkers
+        self.name = 'redis_lua'
+        self.size = size
+        self.tracker = TopTalkers(redis_host, redis_port)
+        self.client = self.tracker.client
+
+    def clear(self):
+        self.tracker.clear(self.table)
+
+    def add(self, key):
+        self.tracker.add(self.table, self.size, key)
+
+    def top_n(self, n):
+        return [(text(key), count) for key, count in
+                self.tracker.top_n_keys_counts(self.table, self.size, n)]
+
+
+def make_backends(names, size, redis_host='localhost', redis_port=6379):
+    """
+    -> list of backends, skipping (with a note) any that can't be set up
+    """
+    factories = {
+        'local-heap': lambda: LocalBackend(size, ENGINE_HEAP),
+        'local-stream_summary': lambda: LocalBackend(size,
+                                                     ENGINE_STREAM_SUMMARY),
+        'local-array': lambda: LocalBackend(size, ENGINE_ARRAY),
+        'with_redis': lambda: WithRedisBackend(size, redis_host, redis_port),
+        'transact-lock': lambda: TransactBackend(size, redis_host, redis_port,
+                                                 'lock'),
+        'transact-watch': lambda: TransactBackend(size, redis_host,
+                                                  redis_port, 'watch'),
+        'transact-script': lambda: TransactBackend(size, redis_host,
+                                                   redis_port, 'script'),
+        'redis_lua': lambda: LuaBackend(size, redis_host, redis_port),
+    }
+    backends = []
+    for name in names:
+        if name not in factories:
+            raise ValueError('Unknown backend: %r' % (name,))
+        try:
+            backend = factories[name]()
+            backend.clear()
+        except Exception as e:
+            print('%s: skipped (%s: %s)' % (name, type(e).__name__, e))
+            continue
+        backends.append(backend)
+    return backends
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    i = min(len(sorted_values) - 1, int(p * len(sorted_values)))
+    return sorted_values[i]
+
+
+def precision_recall(reported, exact, n):
+    """
+    (reported keys, exact Counter, n) -> (precision, recall) of the reported
+    top n against the true top n.  Keys tied with the true n-th count count as
+    correct.
+    """
+    true_top = exact.most_common(n)
+    if not true_top:
+        return 1.0, 1.0
+    threshold = true_top[-1][1]
+    correct = sum(1 for key in reported if exact[key] >= threshold)
+    precision = float(correct) / len(reported) if reported else 1.0
+    recall = float(min(correct, len(true_top))) / len(true_top)
+    return precision, recall
+
+
+def run_backend(backend, keys, n, query_every):
+    """
+    -> dict of the stats for one backend on one workload
+    """
+    backend.clear()
+    add = backend.add
+    add_latencies = []
+    query_latencies = []
+    t0 = clock()
+    for i, key in enumerate(keys):
+        t = clock()
+        add(key)
+        add_latencies.append(clock() - t)
+        if not (i + 1) % query_every:
+            t = clock()
+            backend.top_n(n)
+            query_latencies.append(clock() - t)
+    elapsed = clock() - t0
+
+    reported = [key for key, count in backend.top_n(n)]
+    precision, recall = precision_recall(reported, Counter(keys), n)
+    memory = backend.memory(keys)
+    backend.clear()
+
+    add_latencies.sort()
+    query_latencies.sort()
+    return {
+        'ops_per_sec': len(keys) / elapsed,
+        'add_p50': percentile(add_latencies, 0.5),
+        'add_p99': percentile(add_latencies, 0.99),
+        'query_p50': percentile(query_latencies, 0.5),
+        'query_p99': percentile(query_latencies, 0.99),
+        'memory': memory,
+        'precision': precision,
+        'recall': recall,
+    }
+
+
+def bench(backend_names=None, sizes=(1024, 16384), num_adds=200000,
+          num_redis_adds=20000, num_keys=100000, n=100, query_every=1000,
+          redis_host='localhost', redis_port=6379, seed=0):
+    """
+    Print throughput, add/top_n latency (microseconds), memory and top-n
+    precision/recall for every backend, size and workload.
+
+    Redis backends replay only the first num_redis_adds keys of each
+    workload, since each add is at least one round trip.
+    """
+    if backend_names is None:
+        backend_names = ['local-heap', 'local-stream_summary', 'local-array',
+                         'with_redis', 'transact-lock', 'transact-watch',
+                         'transact-script', 'redis_lua']
+
+    rng = random.Random(seed)
+    streams = [(name, [str(key) for key in keys])
+               for name, keys in workloads(rng, num_adds, num_keys)]
+
+    print('%-22s %-9s %6s %10s %8s %8s %8s %8s %10s %5s %5s' % (
+        'backend', 'workload', 'size', 'ops/s', 'add50', 'add99', 'top50',
+        'top99', 'bytes', 'prec', 'rec'))
+    for size in sizes:
+        for backend in make_backends(backend_names, size, redis_host,
+                                     redis_port):
+            is_local = isinstance(backend, LocalBackend)
+            for workload, keys in streams:
+                if not is_local:
+                    keys = keys[:num_redis_adds]
+                r = run_backend(backend, keys, n, query_every)
+                memory = '-' if r['memory'] is None else '%d' % r['memory']
+                print('%-22s %-9s %6d %10d %8.1f %8.1f %8.1f %8.1f %10s '
+                      '%5.2f %5.2f' % (
+                          backend.name, workload, size, r['ops_per_sec'],
+                          r['add_p50'] * 1e6, r['add_p99'] * 1e6,
+                          r['query_p50'] * 1e6, r['query_p99'] * 1e6, memory,
+                          r['precision'], r['recall']))
+                sys.stdout.flush()
+
+
+def main():
+    """
+    python bench.py [backend ...]
+
+    Redis backends need redis-server on localhost:6379; any that can't
+    connect (or, for with_redis, need Python 2) are skipped.
+    """
+    bench(sys.argv[1:] or None)
+
+
+if __name__ == '__main__':
+    main()
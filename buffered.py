@@ -0,0 +1,192 @@
+import atexit
+import gc
+import logging
+import threading
+import time
+import weakref
+
+from redis_lua import TopTalkers
+
+
+# Trackers created with flush_at_exit and not closed yet.  Only weakly held,
+# so an instance dropped without close() can still be collected.
+open_trackers = weakref.WeakSet()
+
+
+def close_open_trackers():
+    for t in list(open_trackers):
+        t.close()
+
+
+atexit.register(close_open_trackers)
+
+
+def run_flusher(tracker_ref, closed, max_delay):
+    """
+    Flush the tracker every max_delay seconds until it is closed or
+    collected.  Holds it only while flushing.
+    """
+    while not closed.wait(max_delay):
+        t = tracker_ref()
+        if t is None:
+            return
+        try:
+            t.flush()
+        except Exception:
+            logging.exception('Dropped a batch of top talker counts')
+        del t
+
+
+class BufferedTopTalkers(object):
+    """
+    Write-behind front for redis_lua.TopTalkers.
+
+    add() only bumps an in-process count per (table, key).  The buffer is
+    flushed through TopTalkers.add_counts(), every table in one pipelined round
+    trip, once it holds max_keys distinct keys or every max_delay seconds from
+    a background thread.
+
+    Memory is bounded: adds fill a fresh buffer while a flush is in flight,
+    and an add that fills that one too waits for the flush, so at most about
+    2 * max_keys keys are held.  Counts still buffered are lost unless flush()
+    or close() runs; with flush_at_exit, close() runs at exit if it has not
+    yet.  A tracker dropped without close() loses what it still buffers.
+    A flush that fails drops its batch rather than growing the buffer.
+
+    Reads go straight to Redis via .top_talkers and do not see buffered
+    counts.
+    """
+
+    def __init__(self, redis_host='localhost', redis_port=6379,
+                 max_keys=10000, max_delay=1.0, flush_at_exit=True):
+        self.top_talkers = TopTalkers(redis_host, redis_port)
+        self.max_keys = max_keys
+        self.max_delay = max_delay
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.table2size = {}
+        self.table2counts = {}
+        self.num_keys = 0
+        self.closed = threading.Event()
+
+        if max_delay is None:
+            self.flusher = None
+        else:
+            self.flusher = threading.Thread(
+                target=run_flusher,
+                args=(weakref.ref(self), self.closed, max_delay))
+            self.flusher.daemon = True
+            self.flusher.start()
+
+        if flush_at_exit:
+            open_trackers.add(self)
+
+    def add(self, redis_table, redis_size, key, weight=1):
+        """
+        (table, size, key, weight) -> None
+        """
+        with self.lock:
+            counts = self.table2counts.get(redis_table)
+            if counts is None:
+                counts = {}
+                self.table2counts[redis_table] = counts
+            self.table2size[redis_table] = redis_size
+            if key in counts:
+                counts[key] += weight
+            else:
+                counts[key] = weight
+                self.num_keys += 1
+            is_over = self.num_keys >= self.max_keys
+
+        if is_over:
+            self.flush()
+
+    def add_many(self, redis_table, redis_size, keys):
+        """
+        (table, size, keys) -> None
+        """
+        for key in keys:
+            self.add(redis_table, redis_size, key)
+
+    def flush(self):
+        """
+        Send everything buffered so far.  Flushes are serialized, so counts
+        reach Redis in the order they were buffered.
+        """
+        with self.flush_lock:
+            with self.lock:
+                table2size = self.table2size
+                table2counts = self.table2counts
+                self.table2size = {}
+                self.table2counts = {}
+                self.num_keys = 0
+
+            if not table2counts:
+                return
+
+            pipe = self.top_talkers.client.pipeline(transaction=False)
+            for redis_table, counts in table2counts.items():
+                self.top_talkers.add_counts(
+                    redis_table, table2size[redis_table], counts, pipe=pipe)
+            pipe.execute()
+
+    def close(self):
+        """
+        Stop the background flusher and flush what is left.
+        """
+        self.closed.set()
+        open_trackers.discard(self)
+        if self.flusher is not None and \
+                self.flusher is not threading.current_thread():
+            self.flusher.join()
+        self.flush()
+
+
+def main():
+    redis_table = 'top_talkers'
+    redis_size = 4
+
+    t = BufferedTopTalkers(max_keys=3, max_delay=None, flush_at_exit=False)
+    r = t.top_talkers
+
+    r.clear(redis_table)
+
+    t.add(redis_table, redis_size, 'cat')
+    t.add(redis_table, redis_size, 'cat')
+    t.add(redis_table, redis_size, 'dog', 5)
+    assert r.get(redis_table, 'cat') is None
+
+    t.flush()
+    assert r.get(redis_table, 'cat') == 2
+    assert r.get(redis_table, 'dog') == 5
+
+    t.add_many(redis_table, redis_size, ['llama', 'goose', 'cat'])
+    assert r.get(redis_table, 'cat') == 3
+    assert r.top_n_keys_counts(redis_table, redis_size, 2) == [('dog', 5), ('cat', 3)]
+
+    t.add(redis_table, redis_size, 'mouse')
+    t.close()
+    assert r.get(redis_table, 'mouse') == 2
+
+    r.clear(redis_table)
+
+    t = BufferedTopTalkers(max_keys=1000, max_delay=0.05, flush_at_exit=False)
+    t.add(redis_table, redis_size, 'cat')
+    time.sleep(0.5)
+    assert r.get(redis_table, 'cat') == 1
+    t.close()
+
+    # Neither the exit hook nor the flusher keeps an unclosed tracker alive.
+    t = BufferedTopTalkers(max_delay=0.05)
+    flusher = t.flusher
+    t = weakref.ref(t)
+    gc.collect()
+    assert t() is None
+    flusher.join(1)
+    assert not flusher.is_alive()
+
+    r.clear(redis_table)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,349 @@
+from collections import OrderedDict
+import re
+import threading
+import time
+
+
+# Default bounds of a ReadCache.
+CACHE_ENTRIES = 10000
+CACHE_TTL = 1.0
+
+MISSING = object()
+
+GLOB_SPECIAL = re.compile(r'([*?\[\]\\])')
+
+
+def text(redis_key):
+    if isinstance(redis_key, bytes):
+        return redis_key.decode('utf-8', 'replace')
+    return u'%s' % (redis_key,)
+
+
+def owners(redis_key):
+    """
+    'a:b:c' -> ['a:b:c', 'a:b', 'a'], the tables a write to it belongs to
+    """
+    parts = redis_key.split(u':')
+    return [u':'.join(parts[:i]) for i in range(len(parts), 0, -1)]
+
+
+class ReadCache(object):
+    """
+    Bounded LRU of read results, each kept at most ttl seconds.
+
+    Every entry remembers the tables it was read from, as named by the
+    caller, so a write to one of them, or to "<table>:..." (its sketch,
+    names, errors or epochs), can drop it early through invalidate().
+    Entries are only ever as stale as ttl.  Safe to share with an
+    invalidation thread.
+
+    Entries are indexed by table, so invalidating one costs only the entries
+    read from it.  If set, on_new_tables is called with the tables that
+    gain their first entry and on_dropped_tables with those that lose their
+    last one, outside the lock.
+    """
+
+    def __init__(self, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL,
+                 clock=time.time):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = OrderedDict()
+        self.tables = {}
+        self.on_new_tables = None
+        self.on_dropped_tables = None
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, cache_key):
+        """
+        -> the cached value, or MISSING
+        """
+        with self.lock:
+            entry = self.entries.pop(cache_key, None)
+            if entry is None or entry[0] <= self.clock():
+                self.misses += 1
+                return MISSING
+            # Re-inserting moves it to the most recently used end.
+            self.entries[cache_key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def put(self, cache_key, value, redis_tables):
+        redis_tables = [text(k) for k in redis_tables]
+        dropped = []
+        with self.lock:
+            had = set(k for k in redis_tables if k in self.tables)
+            self._drop(cache_key, dropped)
+            self.entries[cache_key] = (self.clock() + self.ttl, value,
+                                       redis_tables)
+            for k in redis_tables:
+                self.tables.setdefault(k, set()).add(cache_key)
+            while len(self.entries) > self.max_entries:
+                self._drop(next(iter(self.entries)), dropped)
+            new_tables = [k for k in set(redis_tables) if k not in had]
+            dropped = [k for k in set(dropped)
+                       if k not in self.tables and k not in had]
+        self._notify(new_tables, dropped)
+
+    def _drop(self, cache_key, dropped):
+        """
+        Drop an entry, appending the tables it leaves empty to dropped.
+        """
+        entry = self.entries.pop(cache_key, None)
+        if entry is None:
+            return
+        for k in entry[2]:
+            cache_keys = self.tables.get(k)
+            if cache_keys is not None:
+                cache_keys.discard(cache_key)
+                if not cache_keys:
+                    del self.tables[k]
+                    dropped.append(k)
+
+    def _notify(self, new_tables, dropped_tables):
+        if new_tables and self.on_new_tables is not None:
+            self.on_new_tables(new_tables)
+        if dropped_tables and self.on_dropped_tables is not None:
+            self.on_dropped_tables(dropped_tables)
+
+    def invalidate(self, redis_key=None):
+        """
+        Drop everything read from redis_key or a table it belongs to, or
+        everything if redis_key is None.
+        """
+        dropped = []
+        with self.lock:
+            if redis_key is None:
+                dropped = list(self.tables)
+                self.entries.clear()
+                self.tables.clear()
+                self.invalidations += 1
+            else:
+                stale = set()
+                for k in owners(text(redis_key)):
+                    stale.update(self.tables.get(k, ()))
+                for cache_key in stale:
+                    self._drop(cache_key, dropped)
+                if stale:
+                    self.invalidations += 1
+        self._notify([], dropped)
+
+    def stats(self):
+        """
+        -> dict of entries, hits, misses, hit_rate and invalidations
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0,
+                'invalidations': self.invalidations,
+            }
+
+
+def cached(f, cache, name, redis_keys):
+    """
+    Wrap f so each distinct call is answered from cache while fresh.
+    redis_keys(args) -> the Redis keys a call reads.
+    """
+    def wrapper(*args):
+        cache_key = (name, args)
+        value = cache.get(cache_key)
+        if value is MISSING:
+            value = f(*args)
+            cache.put(cache_key, value, redis_keys(args))
+        if isinstance(value, list):
+            return list(value)
+        return value
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+def cached_script(script, cache, name, redis_tables):
+    """
+    Wrap a registered Lua script the same way, keyed by its KEYS.
+    redis_tables(keys) -> the tables a call reads.  Calls queued on a
+    pipeline go straight through.
+    """
+    def wrapper(keys=None, args=None, client=None):
+        if client is not None or args:
+            return script(keys=keys, args=args or [], client=client)
+
+        keys = tuple(keys)
+        cache_key = (name, keys)
+        value = cache.get(cache_key)
+        if value is MISSING:
+            value = script(keys=list(keys))
+            cache.put(cache_key, value, redis_tables(keys))
+        if isinstance(value, list):
+            return list(value)
+        return value
+    return wrapper
+
+
+class InvalidationListener(threading.Thread):
+    """
+    Invalidates a ReadCache on keyspace notifications for its tables and
+    their sub-keys ("<table>:...").  Tables are (un)subscribed from this
+    thread, as they are queued by subscribe() and unsubscribe().  Once the
+    server confirms a table's subscription its cached results are dropped
+    too, as writes before that went unreported.
+
+    A table queued for unsubscribe() is only unsubscribed once it has gone
+    grace seconds without being subscribed again, so a table whose entries
+    were just invalidated keeps its subscription while it is re-read.
+    """
+
+    def __init__(self, client, cache, sleep_time=0.1, grace=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        db = client.connection_pool.connection_kwargs.get('db', 0)
+        self.prefix = '__keyspace@%d__:' % db
+        self.cache = cache
+        self.sleep_time = sleep_time
+        self.pubsub = client.pubsub()
+        if grace is None:
+            grace = cache.ttl
+        self.grace = grace
+        self.subscribed = set()
+        self.pending = []
+        # table -> when it was queued for unsubscribe()
+        self.dropped_at = {}
+        self.lock = threading.Lock()
+        self.running = True
+
+    def subscribe(self, redis_tables):
+        with self.lock:
+            self.pending.extend(redis_tables)
+            for table in redis_tables:
+                self.dropped_at.pop(table, None)
+
+    def unsubscribe(self, redis_tables):
+        now = time.time()
+        with self.lock:
+            for table in redis_tables:
+                self.dropped_at[table] = now
+
+    def handler(self, message):
+        self.cache.invalidate(text(message['channel'])[len(self.prefix):])
+
+    def _apply_pending(self):
+        deadline = time.time() - self.grace
+        with self.lock:
+            pending, self.pending = self.pending, []
+            expired = [table for table, at in self.dropped_at.items()
+                       if at <= deadline]
+            for table in expired:
+                del self.dropped_at[table]
+        for table in pending:
+            if table in self.subscribed:
+                continue
+            self.subscribed.add(table)
+            channel = self.prefix + table
+            self.pubsub.subscribe(**{channel: self.handler})
+            self.pubsub.psubscribe(**{self._pattern(channel): self.handler})
+        for table in expired:
+            if table not in self.subscribed:
+                continue
+            self.subscribed.discard(table)
+            channel = self.prefix + table
+            self.pubsub.unsubscribe(channel)
+            self.pubsub.punsubscribe(self._pattern(channel))
+
+    def _pattern(self, channel):
+        return GLOB_SPECIAL.sub(r'\\\1', channel) + ':*'
+
+    def run(self):
+        while self.running:
+            self._apply_pending()
+            if not self.subscribed:
+                time.sleep(self.sleep_time)
+                continue
+            message = self.pubsub.get_message(timeout=self.sleep_time)
+            if message is not None and message['type'] == 'subscribe':
+                self.handler(message)
+        self.pubsub.close()
+
+    def stop(self):
+        self.running = False
+
+
+def subscribe_invalidations(client, cache, redis_tables=None):
+    """
+    Invalidate cache on keyspace notifications for redis_tables, or for the
+    tables cache holds results of while it holds them, and their sub-keys.
+    The server has to publish them, e.g. CONFIG SET notify-keyspace-events
+    Kzh.  Notifications lost while disconnected are only covered by the
+    ttl.
+
+    -> the listener thread; stop() it to unsubscribe
+    """
+    listener = InvalidationListener(client, cache)
+    if redis_tables is None:
+        with cache.lock:
+            listener.subscribe(list(cache.tables))
+        cache.on_new_tables = listener.subscribe
+        cache.on_dropped_tables = listener.unsubscribe
+    else:
+        listener.subscribe([text(k) for k in redis_tables])
+    listener.start()
+    return listener
+
+
+def main():
+    now = [0.0]
+    cache = ReadCache(max_entries=2, ttl=1.0, clock=lambda: now[0])
+    calls = []
+
+    def get(table, key):
+        calls.append((table, key))
+        return len(calls)
+
+    get = cached(get, cache, 'get', lambda args: args[:1])
+    assert get('t', 'cat') == 1
+    assert get('t', 'cat') == 1
+    assert get('t', 'dog') == 2
+    assert get('u', 'cat') == 3
+    # LRU: ('t', 'cat') went first.
+    assert get('t', 'dog') == 2
+    assert get('t', 'cat') == 4
+    now[0] = 1.0
+    assert get('t', 'cat') == 5
+    cache.invalidate('t:errors')
+    assert get('t', 'cat') == 6
+    cache.invalidate('tx')
+    assert get('t', 'cat') == 6
+    stats = cache.stats()
+    assert (stats['hits'], stats['misses'], stats['entries'],
+            stats['invalidations']) == (3, 6, 1, 1)
+    assert sorted(cache.tables) == ['t']
+
+    new_tables = []
+    dropped_tables = []
+    cache.on_new_tables = new_tables.extend
+    cache.on_dropped_tables = dropped_tables.extend
+    assert get('u:1', 'cat') == 7
+    assert get('u:2', 'cat') == 8
+    assert new_tables == ['u:1', 'u:2'] and sorted(cache.tables) == \
+        ['u:1', 'u:2']
+    assert dropped_tables == ['t']
+    # Re-reading a table it holds is no news.
+    now[0] = 2.0
+    assert get('u:2', 'cat') == 9
+    assert new_tables == ['u:1', 'u:2'] and dropped_tables == ['t']
+    # A parent table's write does not reach its sub-keys' results.
+    cache.invalidate('u')
+    assert get('u:2', 'cat') == 9
+    cache.invalidate()
+    assert sorted(dropped_tables) == ['t', 'u:1', 'u:2']
+    assert owners(u'a:b:c') == [u'a:b:c', u'a:b', u'a']
+
+
+if __name__ == '__main__':
+    main()
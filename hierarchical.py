@@ -0,0 +1,323 @@
+from __future__ import print_function
+
+from collections import Counter
+from itertools import repeat
+import random
+import socket
+import struct
+import time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+from local import ENGINE_HEAP, INT_TYPES, TopTalkerTracker
+
+
+PREFIX_LENS = (32, 24, 16)
+
+
+def ip_to_int(address):
+    """
+    '10.1.2.3' (or an int already) -> 167838211
+    """
+    if isinstance(address, INT_TYPES):
+        return address
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def prefix_str(network, prefix_len):
+    """
+    (167838208, 24) -> '10.1.2.0/24'
+    """
+    return '%s/%d' % (socket.inet_ntoa(struct.pack('!I', network)),
+                      prefix_len)
+
+
+def mask(prefix_len):
+    return (0xffffffff << (32 - prefix_len)) & 0xffffffff
+
+
+class HierarchicalTopTalkerTracker(object):
+    """
+    Heavy hitters of IPv4 traffic at several prefix lengths at once.
+
+    There is one Space-Saving tracker of the given size per prefix length,
+    keyed by the masked address as an int.  An address is decoded to an int
+    once and every level's key is a mask of it.  Batches are aggregated once
+    at the finest level and then rolled up, so a coarse level only sees its
+    few distinct networks.
+
+    The levels do not share storage, so memory is that of one tracker per
+    level, and add() still updates every level's tracker: it is only cheaper
+    than independent trackers by the shared decoding (10-15% in bench()).
+    The real savings are add_many(), several times faster per packet, and
+    RHHH.
+
+    With randomized=True (RHHH, Ben Basat et al. 2017) each packet updates a
+    single level picked at random and counts are scaled back up by the
+    number of levels, which makes add() O(1) levels instead of O(levels), at
+    the cost of sampling error that shrinks as traffic grows.
+    """
+
+    def __init__(self, size, prefix_lens=PREFIX_LENS, engine=ENGINE_HEAP,
+                 randomized=False, seed=None):
+        self.size = size
+        self.prefix_lens = sorted(prefix_lens, reverse=True)
+        self.masks = [mask(prefix_len) for prefix_len in self.prefix_lens]
+        self.trackers = [TopTalkerTracker(size, engine)
+                         for prefix_len in self.prefix_lens]
+        self.randomized = randomized
+        self.rng = random.Random(seed)
+
+    def add(self, address, weight=1):
+        ip = ip_to_int(address)
+        if self.randomized:
+            i = int(self.rng.random() * len(self.trackers))
+            self.trackers[i].add(ip & self.masks[i], None, weight)
+            return
+
+        for tracker, level_mask in zip(self.trackers, self.masks):
+            tracker.add(ip & level_mask, None, weight)
+
+    def add_many(self, addresses, weights=None):
+        """
+        Add a batch of addresses (dotted strings or ints), with an optional
+        parallel sequence of weights.
+        """
+        if self.randomized:
+            self._add_sampled(addresses, weights)
+            return
+
+        if weights is None:
+            ip2weight = Counter(addresses)
+        else:
+            ip2weight = Counter()
+            for address, weight in zip(addresses, weights):
+                ip2weight[address] += weight
+        if ip2weight and not isinstance(next(iter(ip2weight)), INT_TYPES):
+            ip2weight = Counter(dict(
+                (ip_to_int(address), weight)
+                for address, weight in ip2weight.items()))
+
+        # Finest level first; each coarser level rolls up the one before.
+        level_counts = ip2weight
+        for tracker, level_mask in zip(self.trackers, self.masks):
+            if level_mask != 0xffffffff:
+                rolled_up = Counter()
+                for network, weight in level_counts.items():
+                    rolled_up[network & level_mask] += weight
+                level_counts = rolled_up
+            tracker.add_counts(level_counts)
+
+    def _add_sampled(self, addresses, weights):
+        """
+        RHHH for a batch: as in add(), each (address, weight) lands whole on
+        one random level.  Levels are then updated once per distinct network.
+        """
+        if weights is None:
+            weights = repeat(1)
+        num_levels = len(self.trackers)
+        random_ = self.rng.random
+        masks = self.masks
+        level_counts = [Counter() for tracker in self.trackers]
+        for address, weight in zip(addresses, weights):
+            i = int(random_() * num_levels)
+            level_counts[i][ip_to_int(address) & masks[i]] += weight
+        for tracker, counts in zip(self.trackers, level_counts):
+            tracker.add_counts(counts)
+
+    def level(self, prefix_len):
+        return self.prefix_lens.index(prefix_len)
+
+    def counts(self, prefix_len):
+        """
+        -> {network: count} of every tracked network at a prefix length,
+        corrected as top_n() corrects them (and scaled up under RHHH)
+        """
+        tracker = self.trackers[self.level(prefix_len)]
+        scale = len(self.trackers) if self.randomized else 1
+        return dict((a.key, a.count * scale)
+                    for a in tracker.top_n(tracker.size))
+
+    def top_n(self, n, prefix_len):
+        """
+        -> list of ('a.b.c.d/len', count), largest first
+        """
+        network_counts = sorted(self.counts(prefix_len).items(),
+                                key=lambda network_count: -network_count[1])
+        return [(prefix_str(network, prefix_len), count)
+                for network, count in network_counts[:n]]
+
+    def heavy_hitters(self, threshold):
+        """
+        -> {prefix_len: list of ('a.b.c.d/len', count)}, every network with
+        at least threshold traffic at every level, largest first
+        """
+        r = {}
+        for prefix_len in self.prefix_lens:
+            r[prefix_len] = [
+                (prefix_str(network, prefix_len), count)
+                for network, count in sorted(
+                    self.counts(prefix_len).items(),
+                    key=lambda network_count: -network_count[1])
+                if count >= threshold]
+        return r
+
+    def hierarchical_heavy_hitters(self, threshold):
+        """
+        -> list of ('a.b.c.d/len', conditioned count), the prefixes whose
+        traffic not already explained by heavier, more specific hitters is
+        at least threshold
+
+        Levels are visited finest first.  A prefix's conditioned count is its
+        count minus the counts of the nearest reported prefixes under it, so
+        a /16 only shows up if it is heavy beyond its heavy /24s and /32s.
+        """
+        hhh = []
+        # (network, prefix_len, count) of reported prefixes not yet covered
+        # by a reported ancestor.
+        reported = []
+        for prefix_len, level_mask in zip(self.prefix_lens, self.masks):
+            level_counts = self.counts(prefix_len)
+            explained = Counter()
+            for network, child_len, count in reported:
+                explained[network & level_mask] += count
+            newly_reported = []
+            for network, count in level_counts.items():
+                conditioned = count - explained[network]
+                if conditioned >= threshold:
+                    hhh.append((prefix_str(network, prefix_len), conditioned))
+                    newly_reported.append((network, prefix_len, count))
+            covered = set(network for network, l, c in newly_reported)
+            reported = [r for r in reported
+                        if r[0] & level_mask not in covered] + newly_reported
+        hhh.sort(key=lambda prefix_count: -prefix_count[1])
+        return hhh
+
+
+def random_addresses(rng, num_packets):
+    """
+    Skewed IPv4 traffic: a few heavy /16s, /24s within them and hosts
+    within those.
+    """
+    def octet(alpha):
+        return min(int(rng.paretovariate(alpha)), 255)
+
+    return ['10.%d.%d.%d' % (octet(1.5), octet(1.2), octet(1.1))
+            for i in range(num_packets)]
+
+
+def check_hierarchical():
+    t = HierarchicalTopTalkerTracker(64)
+    for address in ['10.0.0.1'] * 50 + ['10.0.0.2'] * 5 + ['10.0.1.7'] * 30:
+        t.add(address)
+    t.add_many(['10.1.%d.%d' % (i % 8, i) for i in range(40)])
+    assert t.top_n(1, 32) == [('10.0.0.1/32', 50)]
+    assert t.top_n(2, 24) == [('10.0.0.0/24', 55), ('10.0.1.0/24', 30)]
+    assert t.top_n(2, 16) == [('10.0.0.0/16', 85), ('10.1.0.0/16', 40)]
+    assert t.heavy_hitters(40) == {
+        32: [('10.0.0.1/32', 50)],
+        24: [('10.0.0.0/24', 55)],
+        16: [('10.0.0.0/16', 85), ('10.1.0.0/16', 40)],
+    }
+    # 10.0.0.0/24 is mostly 10.0.0.1 and 10.0.0.0/16 mostly that and
+    # 10.0.1.7, but 10.1.0.0/16 is only heavy as a whole.
+    assert t.hierarchical_heavy_hitters(20) == [
+        ('10.0.0.1/32', 50), ('10.1.0.0/16', 40), ('10.0.1.7/32', 30)]
+
+    # Batches must agree with single adds.
+    rng = random.Random(0)
+    addresses = random_addresses(rng, 5000)
+    single = HierarchicalTopTalkerTracker(100000)
+    batch = HierarchicalTopTalkerTracker(100000)
+    for address in addresses:
+        single.add(address)
+    batch.add_many(addresses[:2000])
+    batch.add_many(addresses[2000:])
+    for prefix_len in PREFIX_LENS:
+        assert single.counts(prefix_len) == batch.counts(prefix_len)
+
+    # RHHH should land near the exact counts on heavy prefixes.
+    sampled = HierarchicalTopTalkerTracker(100000, randomized=True, seed=0)
+    sampled.add_many(addresses)
+    exact = batch.counts(16)
+    for network, count in sampled.counts(16).items():
+        if exact[network] > 1000:
+            assert abs(count - exact[network]) < 0.2 * exact[network]
+
+    # Weighted batches sample once per packet, whatever the weight.
+    weights = [rng.choice([40, 576, 1500]) for address in addresses]
+    sampled = HierarchicalTopTalkerTracker(100000, randomized=True, seed=0)
+    sampled.add_many(addresses, weights)
+    assert sum(sum(sampled.counts(prefix_len).values())
+               for prefix_len in PREFIX_LENS) == 3 * sum(weights)
+    sampled = HierarchicalTopTalkerTracker(100000, randomized=True, seed=0)
+    sampled.add_many(addresses[:10], [0.5] * 10)
+    assert sum(sum(sampled.counts(prefix_len).values())
+               for prefix_len in PREFIX_LENS) == 3 * 5.0
+
+
+def bench(size=4096, num_packets=300000, seed=0):
+    """
+    Print time and memory for hierarchical trackers against one independent
+    TopTalkerTracker per level, keyed by masked int addresses as well.
+    """
+    rng = random.Random(seed)
+    addresses = random_addresses(rng, num_packets)
+    batches = [addresses[i:i + 10000]
+               for i in range(0, len(addresses), 10000)]
+
+    def independent():
+        trackers = [(TopTalkerTracker(size), mask(prefix_len))
+                    for prefix_len in PREFIX_LENS]
+        for address in addresses:
+            for tracker, level_mask in trackers:
+                tracker.add(ip_to_int(address) & level_mask, None)
+        return trackers
+
+    def hierarchical_add():
+        t = HierarchicalTopTalkerTracker(size)
+        for address in addresses:
+            t.add(address)
+        return t
+
+    def hierarchical_add_many():
+        t = HierarchicalTopTalkerTracker(size)
+        for batch in batches:
+            t.add_many(batch)
+        return t
+
+    def rhhh_add():
+        t = HierarchicalTopTalkerTracker(size, randomized=True, seed=seed)
+        for address in addresses:
+            t.add(address)
+        return t
+
+    for name, f in [('independent', independent),
+                    ('hierarchical add', hierarchical_add),
+                    ('hierarchical add_many', hierarchical_add_many),
+                    ('rhhh add', rhhh_add)]:
+        t0 = time.time()
+        f()
+        elapsed = time.time() - t0
+        if tracemalloc is None:
+            memory = '-'
+        else:
+            tracemalloc.start()
+            r = f()
+            memory = '%d' % tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            del r
+        print('%-24s %8d packets/s %12s bytes' % (
+            name, num_packets / elapsed, memory))
+
+
+def main():
+    check_hierarchical()
+    bench()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,418 @@
+from __future__ import print_function
+
+import argparse
+import binascii
+from collections import Counter
+import mmap
+from operator import itemgetter
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import time
+
+from local import ENGINE_HEAP, ENGINES, TopTalkerTracker
+
+
+# Bytes of file parsed per step; lines never straddle chunks.
+CHUNK_SIZE = 1 << 24
+
+# Records aggregated per add_counts() call.
+BATCH_SIZE = 100000
+
+# A flow record is (src, dst, src_port, dst_port, proto, num_bytes), with
+# addresses as text and the rest as ints (0 where the source lacks them).
+SRC, DST, SRC_PORT, DST_PORT, PROTO, NUM_BYTES = range(6)
+
+# CSV header names accepted for each flow field, plain and nfdump-style.
+CSV_COLUMNS = {
+    SRC: ('src', 'src_ip', 'srcaddr', 'sa'),
+    DST: ('dst', 'dst_ip', 'dstaddr', 'da'),
+    SRC_PORT: ('src_port', 'srcport', 'sport', 'sp'),
+    DST_PORT: ('dst_port', 'dstport', 'dport', 'dp'),
+    PROTO: ('proto', 'protocol', 'pr'),
+    NUM_BYTES: ('bytes', 'num_bytes', 'octets', 'ibyt'),
+}
+
+PCAP_MAGIC_USEC = 0xa1b2c3d4
+PCAP_MAGIC_NSEC = 0xa1b23c4d
+
+LINKTYPE_ETHERNET = 1
+LINKTYPE_RAW = 101
+LINKTYPE_LINUX_SLL = 113
+LINKTYPE_IPV4 = 228
+LINKTYPE_IPV6 = 229
+
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+
+PROTO_TCP = 6
+PROTO_UDP = 17
+
+IPV4_HEADER = struct.Struct('!B8xB2x4s4s')
+IPV6_HEADER = struct.Struct('!B5xB2x16s16s')
+PORTS = struct.Struct('!HH')
+ETHERTYPE = struct.Struct('!H')
+
+KEY_FIELDS = {
+    'src': (SRC,),
+    'dst': (DST,),
+    'pair': (SRC, DST),
+    '5tuple': (SRC, DST, SRC_PORT, DST_PORT, PROTO),
+}
+
+
+def iter_lines(path, chunk_size=CHUNK_SIZE):
+    """
+    Yield the lines of a file (as text, without newlines) through mmap, one
+    chunk at a time.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        start = 0
+        while start < size:
+            end = min(start + chunk_size, size)
+            if end < size:
+                newline = m.rfind(b'\n', start, end)
+                if newline < 0:
+                    newline = m.find(b'\n', end)
+                end = size if newline < 0 else newline + 1
+            for line in m[start:end].decode('utf-8').splitlines():
+                yield line
+            start = end
+    finally:
+        m.close()
+
+
+def csv_flows(path, delimiter=',', chunk_size=CHUNK_SIZE):
+    """
+    Yield flow records from a delimited text flow log whose first line names
+    the columns (see CSV_COLUMNS).  Both address columns are required; a
+    missing port, protocol or byte column reads as 0.  Blank lines and lines
+    starting with '#' are skipped.
+    """
+    lines = iter_lines(path, chunk_size)
+    header = None
+    for line in lines:
+        if line and not line.startswith('#'):
+            header = [name.strip().lower() for name in line.split(delimiter)]
+            break
+    if header is None:
+        return
+
+    # Missing columns point one past the end, where every row gets a '0'.
+    columns = []
+    for field in range(6):
+        names = [name for name in CSV_COLUMNS[field] if name in header]
+        if names:
+            columns.append(header.index(names[0]))
+        elif field in (SRC, DST):
+            raise ValueError('No %s address column in %r' % (
+                CSV_COLUMNS[field][0], path))
+        else:
+            columns.append(len(header))
+    get_fields = itemgetter(*columns)
+
+    for line in lines:
+        if not line or line[0] == '#':
+            continue
+        fields = line.split(delimiter)
+        fields.append('0')
+        src, dst, src_port, dst_port, proto, num_bytes = get_fields(fields)
+        yield (src, dst, int(src_port), int(dst_port), int(proto),
+               int(num_bytes))
+
+
+def ip_flow(buf, pos, end, num_bytes):
+    """
+    Parse the IPv4/IPv6 packet at buf[pos:end] -> flow record, or None
+    """
+    if end - pos < 20:
+        return None
+
+    version_ihl, proto, src, dst = IPV4_HEADER.unpack_from(buf, pos)
+    if version_ihl >> 4 == 4:
+        src = socket.inet_ntop(socket.AF_INET, src)
+        dst = socket.inet_ntop(socket.AF_INET, dst)
+        pos += (version_ihl & 15) * 4
+    elif version_ihl >> 4 == 6:
+        if end - pos < 40:
+            return None
+        version, proto, src, dst = IPV6_HEADER.unpack_from(buf, pos)
+        src = socket.inet_ntop(socket.AF_INET6, src)
+        dst = socket.inet_ntop(socket.AF_INET6, dst)
+        pos += 40
+    else:
+        return None
+
+    if (proto == PROTO_TCP or proto == PROTO_UDP) and end - pos >= 4:
+        src_port, dst_port = PORTS.unpack_from(buf, pos)
+        return (src, dst, src_port, dst_port, proto, num_bytes)
+    return (src, dst, 0, 0, proto, num_bytes)
+
+
+def pcap_flows(path):
+    """
+    Yield one flow record per IP packet of a classic (not pcapng) capture,
+    weighted by its length on the wire.  Ethernet (with VLAN tags), Linux
+    cooked and raw IP link types are understood; other packets are skipped.
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < 24:
+            return
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    try:
+        for endian in '<>':
+            magic = struct.unpack_from(endian + 'I', m, 0)[0]
+            if magic in (PCAP_MAGIC_USEC, PCAP_MAGIC_NSEC):
+                break
+        else:
+            raise ValueError('Not a pcap file: %r' % (path,))
+        linktype = struct.unpack_from(endian + 'I', m, 20)[0] & 0xffff
+        record = struct.Struct(endian + 'IIII')
+
+        pos = 24
+        while pos + 16 <= size:
+            ts, ts_frac, incl_len, orig_len = record.unpack_from(m, pos)
+            start = pos + 16
+            pos = start + incl_len
+            end = pos if pos < size else size
+
+            if linktype == LINKTYPE_ETHERNET:
+                if end - start < 14:
+                    continue
+                ethertype, = ETHERTYPE.unpack_from(m, start + 12)
+                start += 14
+                while ethertype in ETHERTYPE_VLAN and end - start >= 4:
+                    ethertype, = ETHERTYPE.unpack_from(m, start + 2)
+                    start += 4
+                if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+                    continue
+            elif linktype == LINKTYPE_LINUX_SLL:
+                if end - start < 16:
+                    continue
+                ethertype, = ETHERTYPE.unpack_from(m, start + 14)
+                if ethertype not in (ETHERTYPE_IPV4, ETHERTYPE_IPV6):
+                    continue
+                start += 16
+            elif linktype not in (LINKTYPE_RAW, LINKTYPE_IPV4, LINKTYPE_IPV6):
+                raise ValueError('Unsupported pcap link type: %d' % linktype)
+
+            flow = ip_flow(m, start, end, orig_len)
+            if flow is not None:
+                yield flow
+    finally:
+        m.close()
+
+
+def prefix(address, prefix_len):
+    """
+    ('10.1.2.3', 24) -> '10.1.2.0/24'
+    """
+    family = socket.AF_INET6 if ':' in address else socket.AF_INET
+    packed = socket.inet_pton(family, address)
+    num_bits = len(packed) * 8
+    n = int(binascii.hexlify(packed), 16)
+    n &= ((1 << num_bits) - 1) ^ ((1 << (num_bits - prefix_len)) - 1)
+    packed = binascii.unhexlify('%0*x' % (len(packed) * 2, n))
+    return '%s/%d' % (socket.inet_ntop(family, packed), prefix_len)
+
+
+def make_key(spec):
+    """
+    Key spec -> function from flow record to key.
+
+    Specs: 'src', 'dst', 'pair' (src, dst), '5tuple', or 'src/<bits>' /
+    'dst/<bits>' for the address's network prefix.
+    """
+    if '/' in spec:
+        field, prefix_len = spec.split('/')
+        if field not in ('src', 'dst'):
+            raise ValueError('Unknown key: %r' % (spec,))
+        index = KEY_FIELDS[field][0]
+        prefix_len = int(prefix_len)
+        return lambda flow: prefix(flow[index], prefix_len)
+
+    if spec not in KEY_FIELDS:
+        raise ValueError('Unknown key: %r' % (spec,))
+    fields = KEY_FIELDS[spec]
+    if len(fields) == 1:
+        index = fields[0]
+        return lambda flow: flow[index]
+    return lambda flow: tuple(flow[i] for i in fields)
+
+
+def feed(tracker, flows, key='src', weight_by_bytes=False,
+         batch_size=BATCH_SIZE):
+    """
+    Count flow records into a tracker, batch_size records per add_counts()
+    call.  Each record weighs 1, or its byte count with weight_by_bytes.
+
+    -> number of records read
+    """
+    key_of = make_key(key)
+    num_records = 0
+    key2weight = Counter()
+    for flow in flows:
+        if weight_by_bytes:
+            key2weight[key_of(flow)] += flow[NUM_BYTES]
+        else:
+            key2weight[key_of(flow)] += 1
+        num_records += 1
+        if not num_records % batch_size:
+            tracker.add_counts(key2weight)
+            key2weight = Counter()
+    if key2weight:
+        tracker.add_counts(key2weight)
+    return num_records
+
+
+def file_flows(path, file_format=None, delimiter=','):
+    """
+    Flow records of a file, by format ('csv' or 'pcap'; guessed from the
+    extension if not given).
+    """
+    if file_format is None:
+        if path.endswith(('.pcap', '.cap')):
+            file_format = 'pcap'
+        else:
+            file_format = 'csv'
+    if file_format == 'pcap':
+        return pcap_flows(path)
+    if file_format == 'csv':
+        return csv_flows(path, delimiter)
+    raise ValueError('Unknown format: %r' % (file_format,))
+
+
+def random_flow(rng, num_hosts=5000):
+    """
+    A random flow record; hosts are Pareto-distributed, so a few are heavy.
+    """
+    src = min(int(rng.paretovariate(1.2)), num_hosts)
+    dst = rng.randrange(num_hosts)
+    return ('10.%d.%d.%d' % (src >> 16, (src >> 8) & 255, src & 255),
+            '192.168.%d.%d' % (dst >> 8 & 255, dst & 255),
+            rng.randrange(1024, 65536), rng.choice([53, 80, 443]),
+            rng.choice([PROTO_TCP, PROTO_UDP]), rng.randrange(40, 1500))
+
+
+def write_csv(path, flows):
+    with open(path, 'w') as f:
+        f.write('src_ip,dst_ip,src_port,dst_port,proto,bytes\n')
+        for flow in flows:
+            f.write('%s,%s,%d,%d,%d,%d\n' % flow)
+
+
+def write_pcap(path, flows):
+    """
+    Write flows as one Ethernet/IPv4 packet each (headers only, with the
+    flow's byte count as the wire length).
+    """
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<IHHiIII', PCAP_MAGIC_USEC, 2, 4, 0, 0, 65535,
+                            LINKTYPE_ETHERNET))
+        for flow in flows:
+            src, dst, src_port, dst_port, proto, num_bytes = flow
+            packet = (b'\0' * 12 + struct.pack('!H', ETHERTYPE_IPV4) +
+                      struct.pack('!BBHHHBBH4s4s', 0x45, 0, num_bytes - 14, 0,
+                                  0, 64, proto, 0,
+                                  socket.inet_aton(src), socket.inet_aton(dst)) +
+                      struct.pack('!HH', src_port, dst_port))
+            f.write(struct.pack('<IIII', 0, 0, len(packet), num_bytes))
+            f.write(packet)
+
+
+def check_ingest(num_flows=20000, seed=0):
+    """
+    CSV and pcap copies of the same flows must produce the same counts as
+    counting them directly.
+    """
+    rng = random.Random(seed)
+    flows = [random_flow(rng) for i in range(num_flows)]
+    tmp_dir = tempfile.mkdtemp()
+    csv_path = os.path.join(tmp_dir, 'flows.csv')
+    pcap_path = os.path.join(tmp_dir, 'flows.pcap')
+    write_csv(csv_path, flows)
+    write_pcap(pcap_path, flows)
+
+    assert list(csv_flows(csv_path, chunk_size=1000)) == flows
+    assert list(pcap_flows(pcap_path)) == flows
+
+    for key in ('src', 'pair', '5tuple', 'src/16'):
+        key_of = make_key(key)
+        exact = Counter(key_of(flow) for flow in flows)
+        for path in (csv_path, pcap_path):
+            t = TopTalkerTracker(len(exact))
+            assert feed(t, file_flows(path), key, batch_size=999) == num_flows
+            assert dict((k, t.get(k).count) for k in exact) == dict(exact)
+
+    t = TopTalkerTracker(16)
+    feed(t, file_flows(pcap_path), 'src', weight_by_bytes=True)
+    heaviest = Counter()
+    for flow in flows:
+        heaviest[flow[SRC]] += flow[NUM_BYTES]
+    assert t.top_n(1)[0].key == heaviest.most_common(1)[0][0]
+
+    assert prefix('10.1.2.3', 24) == '10.1.2.0/24'
+    assert prefix('2001:db8::1', 32) == '2001:db8::/32'
+
+    for path in (csv_path, pcap_path):
+        os.remove(path)
+    os.rmdir(tmp_dir)
+
+
+def main(argv=None):
+    """
+    python ingest.py [options] file ...
+
+    With no files, runs the self-check instead.
+    """
+    parser = argparse.ArgumentParser(
+        description='Print the top talkers of flow logs or pcaps.')
+    parser.add_argument('paths', nargs='*', metavar='file')
+    parser.add_argument('--format', choices=['csv', 'pcap'],
+                        help='file format (default: by extension)')
+    parser.add_argument('--delimiter', default=',')
+    parser.add_argument('--key', default='src',
+                        help="src, dst, pair, 5tuple, src/<bits> or "
+                             "dst/<bits> (default: src)")
+    parser.add_argument('--bytes', action='store_true',
+                        help='weight records by bytes instead of 1')
+    parser.add_argument('--size', type=int, default=16384)
+    parser.add_argument('--engine', choices=sorted(ENGINES),
+                        default=ENGINE_HEAP)
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+    parser.add_argument('-n', type=int, default=20, help='rows to print')
+    args = parser.parse_args(argv)
+
+    if not args.paths:
+        check_ingest()
+        return
+
+    t = TopTalkerTracker(args.size, args.engine)
+    num_records = 0
+    t0 = time.time()
+    for path in args.paths:
+        num_records += feed(t, file_flows(path, args.format, args.delimiter),
+                            args.key, args.bytes, args.batch_size)
+    elapsed = time.time() - t0
+
+    for a in t.top_n(args.n):
+        print('%12d  %s' % (a.count, a.key))
+    print('%d records in %.1fs, %d records/s' % (
+        num_records, elapsed, num_records / max(elapsed, 1e-9)),
+        file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,78 @@
+from __future__ import print_function
+
+from array import array
+from bisect import bisect_left, insort
+from collections import Counter
 import heapq
+import mmap
+from operator import attrgetter, itemgetter
+import os
+import random
+import struct
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+ENGINE_HEAP = 'heap'
+ENGINE_STREAM_SUMMARY = 'stream_summary'
+ENGINE_ARRAY = 'array'
+
+# Bumped whenever the layout of _state() changes.
+STATE_VERSION = 1
+
+INFINITY = float('inf')
+
+# Typecodes for the array engine: 64-bit counts ('q' is Python 3 only) and
+# heap positions.
+try:
+    array('q')
+    COUNT_TYPECODE = 'q'
+except ValueError:
+    COUNT_TYPECODE = 'l'
+POS_TYPECODE = 'l'
+
+# Binary snapshots (see write_snapshot).
+SNAPSHOT_MAGIC = b'TTKR'
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct('<4sHHQQ16s')
+SNAPSHOT_SATURATED = 1
+SNAPSHOT_FLOAT_COUNTS = 2
+SNAPSHOT_HAS_DATA = 4
+SNAPSHOT_HAS_FLOOR = 8
+SNAPSHOT_HAS_ERRORS = 16
+SNAPSHOT_FLAGS = (SNAPSHOT_SATURATED | SNAPSHOT_FLOAT_COUNTS |
+                  SNAPSHOT_HAS_DATA | SNAPSHOT_HAS_FLOOR | SNAPSHOT_HAS_ERRORS)
+KEY_INT64 = 0
+KEY_UINT64 = 1
+KEY_BYTES = 2
+KEY_TEXT = 3
+
+try:
+    INT_TYPES = (int, long)
+except NameError:
+    INT_TYPES = (int,)
 
 
 class TopTalkerTrackerItem(object):
+    __slots__ = ('key', 'count', 'data')
+
     def __init__(self, key, count, data):
         self.key = key
         self.count = count
@@ -14,73 +85,1693 @@ class TopTalkerTrackerItem(object):
         return self.count < other.count
 
 
+class AddStats(object):
+    """
+    add() calls by outcome, kept while stats are enabled.
+    """
+
+    __slots__ = ('adds', 'hits', 'inserts', 'evictions', 'rejections')
+
+    def __init__(self):
+        self.adds = 0
+        self.hits = 0
+        self.inserts = 0
+        self.evictions = 0
+        self.rejections = 0
+
+
+class CountMinSketch(object):
+    """
+    depth rows of width counters; a key's estimate is the smallest of its
+    counters, which never undercounts it.  Row i uses h1 + i * h2 from one
+    salted hash of the key (Kirsch-Mitzenmacher double hashing).
+    """
+
+    def __init__(self, width, depth=4, seed=0):
+        self.width = width
+        self.depth = depth
+        self.salt = random.Random(seed).getrandbits(32)
+        self.counts = array('d', [0.0]) * (width * depth)
+
+    def _slots(self, key):
+        h = hash((self.salt, key))
+        h1 = h & 0xffffffff
+        h2 = (h >> 32) | 1
+        width = self.width
+        return [i * width + (h1 + i * h2) % width for i in range(self.depth)]
+
+    def add(self, key, weight=1):
+        """
+        -> the key's estimate after adding weight
+        """
+        counts = self.counts
+        estimate = INFINITY
+        for i in self._slots(key):
+            counts[i] += weight
+            if counts[i] < estimate:
+                estimate = counts[i]
+        return estimate
+
+    def estimate(self, key):
+        counts = self.counts
+        return min(counts[i] for i in self._slots(key))
+
+
 class TopTalkerTracker(object):
-    def __init__(self, size):
+    """
+    Space-Saving top talker tracker.
+
+    The engine is picked at construction time:
+
+        TopTalkerTracker(size)                         # heap, O(log size) add
+        TopTalkerTracker(size, ENGINE_STREAM_SUMMARY)  # buckets, O(1) unit add
+        TopTalkerTracker(size, ENGINE_ARRAY)           # heap in typed arrays
+
+    Engines implement add(), _min_count(), _largest(n), _entries() and
+    _load(entries); everything else is shared.
+
+    Every entry also keeps its error: the count it took over when it was
+    inserted, i.e. how far its count may overstate the key's (0 for keys
+    that never evicted anything).  top_n_bounds() reports it.
+
+    A tracker merged from full summaries into a larger size is not full, but
+    any key it lacks may still have had up to the inputs' summed minimums.
+    That floor is kept in _merged_floor: new keys start there, as if they
+    had evicted an entry of that count.
+
+    top_n() keeps the members of its last answer.  Until some other key's
+    count rises above the smallest of them, the next answer is those same
+    members re-sorted, which is O(n) rather than a scan of the whole table.
+    Engines call _crossed(key) whenever a count exceeds _top_floor and
+    _reset_top() when a member is evicted or the table is reloaded.
+    """
+
+    engine = None
+
+    def __new__(cls, size, engine=ENGINE_HEAP):
+        if cls is TopTalkerTracker:
+            if engine not in ENGINES:
+                raise ValueError('Unknown engine: %r' % (engine,))
+            cls = ENGINES[engine]
+        return object.__new__(cls)
+
+    def __init__(self, size, engine=ENGINE_HEAP):
         self.size = size
         self.is_saturated = False
         self.key2entry = {}
-        self.heap = []
+        self._merged_floor = 0
+        self._add_stats = None
+        self._sketch = None
+        self._reset_top()
+
+    def _reset_top(self):
+        self._top = None
+        self._top_n = 0
+        self._top_keys = frozenset()
+        self._top_floor = INFINITY
+
+    def _crossed(self, key):
+        if key not in self._top_keys:
+            self._reset_top()
 
     def is_full(self):
         if self.is_saturated:
             return True
 
-        self.is_saturated = len(self.heap) >= self.size
+        self.is_saturated = len(self.key2entry) >= self.size
         return self.is_saturated
 
     def get(self, key):
         return self.key2entry[key]
 
     def contains(self, key):
-        e = self.key2entry.get(key)
-        return bool(e)
+        return key in self.key2entry
+
+    def enable_stats(self):
+        """
+        Start counting add() calls as hits, inserts, evictions and admission
+        rejections (see stats()).
+
+        The counting add() is set on this instance and calls the engine's; a
+        tracker that never enables stats runs the engine's add() untouched.
+        Batches count once per distinct key, since that is what they apply.
+        """
+        if self._add_stats is not None:
+            return
+
+        self._add_stats = add_stats = AddStats()
+        engine_add = self.add
+
+        def add(key, data, weight=1):
+            add_stats.adds += 1
+            if key in self.key2entry:
+                add_stats.hits += 1
+                engine_add(key, data, weight)
+            elif not self.is_full():
+                add_stats.inserts += 1
+                engine_add(key, data, weight)
+            else:
+                engine_add(key, data, weight)
+                if key in self.key2entry:
+                    add_stats.evictions += 1
+                else:
+                    add_stats.rejections += 1
+
+        self.add = add
+
+    def disable_stats(self):
+        self.__dict__.pop('add', None)
+        self._add_stats = None
+
+    def stats(self):
+        """
+        -> dict of size, tracked, is_full and min_count, plus adds, hits,
+        inserts, evictions, rejections, hit_rate and eviction_rate while stats
+        are enabled.
+
+        A tracker that evicts on most adds is too small for its stream: its
+        min_count, the error bound on every count, keeps climbing.
+        """
+        r = {
+            'size': self.size,
+            'tracked': len(self.key2entry),
+            'is_full': self.is_full(),
+            'min_count': self._min_count() if self.key2entry else 0,
+        }
+        add_stats = self._add_stats
+        if add_stats is not None:
+            adds = add_stats.adds
+            r['adds'] = adds
+            r['hits'] = add_stats.hits
+            r['inserts'] = add_stats.inserts
+            r['evictions'] = add_stats.evictions
+            r['rejections'] = add_stats.rejections
+            r['hit_rate'] = float(add_stats.hits) / adds if adds else 0.0
+            r['eviction_rate'] = \
+                float(add_stats.evictions) / adds if adds else 0.0
+        return r
+
+    def enable_admission(self, width=None, depth=4, seed=0):
+        """
+        Gate evictions behind a Count-Min sketch (TinyLFU-style admission).
+
+        Once the table is full, a new key's weight goes into the sketch and the
+        key only replaces the minimum if its estimate is above the minimum's
+        count; otherwise the add is dropped.  An admitted key starts at the
+        larger of min + weight and its estimate.  One-off keys from a long
+        tail then stop evicting real contenders, at the cost of the strict
+        Space-Saving bound: a rejected add is not counted in the table.
+        width defaults to 4 * size.
+        """
+        if width is None:
+            width = 4 * self.size
+        self._sketch = CountMinSketch(width, depth, seed)
+
+    def disable_admission(self):
+        self._sketch = None
+
+    def _admit(self, key, weight):
+        """
+        -> the weight to evict the minimum with, or 0 to drop the add
+        """
+        estimate = self._sketch.add(key, weight)
+        min_count = self._min_count()
+        if estimate <= min_count:
+            return 0
+        if isinstance(weight, INT_TYPES):
+            estimate = int(estimate)
+        return max(weight, estimate - min_count)
+
+    def add_many(self, keys, data=None):
+        """
+        Add a batch of keys, counting each occurrence once.
+
+        Duplicates are collapsed first and every distinct key is applied once
+        with its total weight.  data, if given, is a sequence parallel to keys;
+        the last datum for a key wins, as it would with sequential adds.
+
+        Keys already tracked are applied first, so nothing in the batch evicts
+        them before their own hits land, then new keys heaviest first.  Weighted
+        Space-Saving keeps its bounds under any order, so counts and the top_n
+        min offset carry the same guarantees as sequential adds.
+        """
+        if data is None:
+            key2data = {}
+        else:
+            # keys is read twice, which would use up a generator.
+            keys = list(keys)
+            key2data = dict(zip(keys, data))
+        key2weight = Counter(keys)
+        self._add_distinct(key2weight.keys(), key2weight.values(), key2data)
+
+    def add_counts(self, key2weight):
+        """
+        Add pre-aggregated {key: weight} counts with no data, applied as by
+        add_many().
+        """
+        self._add_distinct(key2weight.keys(), key2weight.values(), {})
+
+    def _add_distinct(self, keys, weights, key2data):
+        """
+        Apply distinct keys with their weights: tracked keys first, then new
+        keys heaviest first.
+        """
+        add = self.add
+        key2entry = self.key2entry
+        new_keys_weights = []
+        for key, weight in zip(keys, weights):
+            if key in key2entry:
+                add(key, key2data.get(key), weight)
+            else:
+                new_keys_weights.append((key, weight))
+
+        new_keys_weights.sort(key=itemgetter(1), reverse=True)
+        for key, weight in new_keys_weights:
+            add(key, key2data.get(key), weight)
+
+    def add_array(self, keys, weights=None):
+        """
+        Add an integer ndarray of keys (IPv4 addresses as uint32, flow IDs as
+        uint64, ...), with an optional parallel array of weights.
+
+        The batch is aggregated with np.unique/np.bincount and then applied
+        like add_many(), so each distinct key costs one add.  Keys are stored
+        as Python ints with no data.  Needs numpy.
+        """
+        if np is None:
+            raise ImportError('add_array() needs numpy')
+
+        keys = np.asarray(keys)
+        self._key_dtype = keys.dtype
+        if weights is None:
+            distinct, counts = np.unique(keys, return_counts=True)
+        else:
+            weights = np.asarray(weights)
+            distinct, inverse = np.unique(keys, return_inverse=True)
+            counts = np.bincount(inverse.ravel(), weights=weights.ravel(),
+                                 minlength=len(distinct))
+            if weights.dtype.kind in 'iub':
+                counts = counts.astype(np.int64)
+        self._add_distinct(distinct.tolist(), counts.tolist(), {})
+
+    def top_n_arrays(self, n, dtype=None):
+        """
+        top_n() as a pair of ndarrays (keys, counts).  Keys default to the
+        dtype of the last add_array() batch.  Needs numpy.
+        """
+        if np is None:
+            raise ImportError('top_n_arrays() needs numpy')
+
+        if dtype is None:
+            dtype = getattr(self, '_key_dtype', None)
+        members = self.top_n(n)
+        keys = np.array([m.key for m in members], dtype=dtype)
+        counts = np.array([m.count for m in members], dtype=np.int64)
+        return keys, counts
+
+    def _floor(self):
+        """
+        Upper bound on the count of any key this summary is not tracking.
+        """
+        if self.is_full():
+            return self._min_count()
+        return self._merged_floor
+
+    def merge(self, other):
+        """
+        Fold another summary into this one, keeping self.size entries.
+        """
+        self.merge_all([other])
+
+    def merge_all(self, trackers):
+        trackers = [self] + list(trackers)
+        total_floor = sum(t._floor() for t in trackers)
+        entries = merge_entries(trackers, self.size)
+        self._load(entries)
+        self.is_saturated = len(entries) >= self.size
+        self._merged_floor = total_floor
+
+    @classmethod
+    def merged(cls, trackers, size, engine=ENGINE_HEAP):
+        """
+        Combine several trackers' summaries into a new tracker of the given
+        size, e.g. per-process shards shipped back with dumps().
+        """
+        t = cls(size, engine)
+        t.merge_all(trackers)
+        return t
+
+    def _entries(self):
+        """
+        -> list of (key, count, data, error)
+        """
+        return [(e.key, e.count, e.data, e.error)
+                for e in self.key2entry.values()]
+
+    def _state(self):
+        entries = self._entries()
+        return (STATE_VERSION, self.engine, self.size, self.is_saturated,
+                [e[0] for e in entries], [e[1] for e in entries],
+                [e[2] for e in entries], [e[3] for e in entries],
+                self._merged_floor)
+
+    def __reduce__(self):
+        return (from_state, (self._state(),))
+
+    def dumps(self):
+        """
+        Serialize as parallel key/count/data lists, which pickle far smaller
+        and faster than the engine's object graph.
+        """
+        return pickle.dumps(self._state(), pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(s):
+        return from_state(pickle.loads(s))
+
+    def save(self, path, background=False):
+        """
+        Write a binary snapshot (see write_snapshot) to path, atomically.
 
-    def add(self, key, data):
+        Only copying the entries happens on the caller's thread.  With
+        background=True encoding and writing happen on a SnapshotWriter
+        thread, which is returned; its join() re-raises a failed write.
+        """
+        args = (path, self.engine, self.size, self.is_full(), self._entries(),
+                self._merged_floor)
+        if not background:
+            write_snapshot(*args)
+            return None
+
+        thread = SnapshotWriter(args)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def load(path):
+        return read_snapshot(path)
+
+    def top_n(self, n):
+        if n <= 0:
+            return []
+
+        members = self._top
+        if members is None or self._top_n < n:
+            members = self._largest(n)
+            self._top = members
+            self._top_n = n
+            self._top_keys = frozenset(m.key for m in members)
+        else:
+            members.sort(key=attrgetter('count'), reverse=True)
+
+        # With fewer members than asked for, any new key gets in.
+        if len(members) < self._top_n:
+            self._top_floor = -INFINITY
+        else:
+            self._top_floor = members[-1].count
+        members = members[:n]
+
+        floor = self._floor()
+        if floor:
+            the_min = floor - 1
+        else:
+            the_min = 0
+        return [TopTalkerTrackerItem(m.key, m.count - the_min, m.data)
+                for m in members]
+
+    def top_n_bounds(self, n):
+        """
+        -> list of (key, count, error, guaranteed), largest first
+
+        The key's true count is between count - error and count.  guaranteed
+        means it is in the true top n whatever the stream was: count - error
+        is at least the count of every key not returned, tracked or not.
+        With admission enabled counts are no longer upper bounds, so nothing
+        is guaranteed.
+        """
+        members = self._largest(n + 1)
+        if len(members) > n:
+            threshold = members[n].count
+        else:
+            threshold = self._floor()
+        exact = self._sketch is None
+        return [(m.key, m.count, m.error,
+                 exact and m.count - m.error >= threshold)
+                for m in members[:n]]
+
+
+class HeapItem(TopTalkerTrackerItem):
+    __slots__ = ('pos', 'error')
+
+    def __init__(self, key, count, data, pos, error=0):
+        TopTalkerTrackerItem.__init__(self, key, count, data)
+        self.pos = pos
+        self.error = error
+
+
+class HeapTopTalkerTracker(TopTalkerTracker):
+    """
+    A binary min-heap on count.  Items remember their heap position, so a hit
+    or an eviction bumps the count in place and sinks the item.
+    """
+
+    engine = ENGINE_HEAP
+
+    def __init__(self, size, engine=ENGINE_HEAP):
+        TopTalkerTracker.__init__(self, size, engine)
+        self.heap = []
+
+    def _swim(self, pos):
+        heap = self.heap
+        item = heap[pos]
+        while pos:
+            parent_pos = (pos - 1) >> 1
+            parent = heap[parent_pos]
+            if parent.count <= item.count:
+                break
+            heap[pos] = parent
+            parent.pos = pos
+            pos = parent_pos
+        heap[pos] = item
+        item.pos = pos
+
+    def _sink(self, pos):
+        heap = self.heap
+        end = len(heap)
+        item = heap[pos]
+        child_pos = 2 * pos + 1
+        while child_pos < end:
+            right_pos = child_pos + 1
+            if right_pos < end and \
+                    heap[right_pos].count < heap[child_pos].count:
+                child_pos = right_pos
+            child = heap[child_pos]
+            if item.count <= child.count:
+                break
+            heap[pos] = child
+            child.pos = pos
+            pos = child_pos
+            child_pos = 2 * pos + 1
+        heap[pos] = item
+        item.pos = pos
+
+    def add(self, key, data, weight=1):
         item = self.key2entry.get(key)
         if item:
-            item.count += 1
+            item.count += weight
             item.data = data
-            heapq.heapreplace(self.heap, item)
+            self._sink(item.pos)
+            if item.count > self._top_floor:
+                self._crossed(key)
             return
 
         if self.is_full():
-            old = heapq.heappop(self.heap)
+            if self._sketch is not None:
+                weight = self._admit(key, weight)
+                if not weight:
+                    return
+            old = self.heap[0]
+            if old.key in self._top_keys:
+                self._reset_top()
             del self.key2entry[old.key]
             old.key = key
-            old.count += 1
+            old.error = old.count
+            old.count += weight
             old.data = data
             self.key2entry[key] = old
-            heapq.heappush(self.heap, old)
+            self._sink(0)
+            if old.count > self._top_floor:
+                self._crossed(key)
             return
 
-        item = TopTalkerTrackerItem(key, 1, data)
-        heapq.heappush(self.heap, item)
+        floor = self._merged_floor
+        item = HeapItem(key, floor + weight, data, len(self.heap), floor)
+        self.heap.append(item)
+        self._swim(item.pos)
         self.key2entry[key] = item
+        if item.count > self._top_floor:
+            self._crossed(key)
 
-    def top_n(self, n):
-        members = heapq.nlargest(n, self.heap)
+    def _min_count(self):
+        return self.heap[0].count
+
+    def _largest(self, n):
+        return heapq.nlargest(n, self.heap)
+
+    def _load(self, entries):
+        # Ascending order is already a valid heap.
+        self._reset_top()
+        self.key2entry = {}
+        self.heap = []
+        for key, count, data, error in sorted(entries, key=itemgetter(1)):
+            item = HeapItem(key, count, data, len(self.heap), error)
+            self.heap.append(item)
+            self.key2entry[key] = item
+
+
+class StreamSummaryItem(object):
+    __slots__ = ('key', 'count', 'data', 'bucket', 'error')
+
+    def __init__(self, key, count, data, bucket, error=0):
+        self.key = key
+        self.count = count
+        self.data = data
+        self.bucket = bucket
+        self.error = error
+
+
+class StreamSummaryBucket(object):
+    __slots__ = ('count', 'key2item', 'prev', 'next')
+
+    def __init__(self, count):
+        self.count = count
+        self.key2item = {}
+        self.prev = None
+        self.next = None
+
+
+class StreamSummaryTopTalkerTracker(TopTalkerTracker):
+    """
+    The "stream summary" layout from the Space-Saving paper: a doubly linked
+    list of buckets in ascending count order, each holding every item with that
+    count.  A unit increment moves an item to the neighbouring bucket and an
+    eviction takes any item from the lowest bucket, so both are O(1).
+
+    Buckets are also indexed by count (count2bucket, and the sorted
+    bucket_counts), so a weighted increment that jumps past other buckets
+    finds its place by bisection rather than by walking the list.
+    """
+
+    engine = ENGINE_STREAM_SUMMARY
+
+    def __init__(self, size, engine=ENGINE_STREAM_SUMMARY):
+        TopTalkerTracker.__init__(self, size, engine)
+        self.min_bucket = None
+        self.max_bucket = None
+        self.count2bucket = {}
+        self.bucket_counts = []
+
+    def _link_after(self, prev, count):
+        """
+        Insert a new bucket after prev (or at the head if prev is None).
+        """
+        bucket = StreamSummaryBucket(count)
+        self.count2bucket[count] = bucket
+        insort(self.bucket_counts, count)
+        if prev is None:
+            nxt = self.min_bucket
+            self.min_bucket = bucket
+        else:
+            nxt = prev.next
+            prev.next = bucket
+        bucket.prev = prev
+        bucket.next = nxt
+        if nxt is None:
+            self.max_bucket = bucket
+        else:
+            nxt.prev = bucket
+        return bucket
+
+    def _unlink(self, bucket):
+        del self.count2bucket[bucket.count]
+        del self.bucket_counts[bisect_left(self.bucket_counts, bucket.count)]
+        if bucket.prev is None:
+            self.min_bucket = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is None:
+            self.max_bucket = bucket.prev
+        else:
+            bucket.next.prev = bucket.prev
+
+    def _bucket_for(self, prev, count):
+        """
+        Find or create the bucket for count, which belongs after prev (or
+        anywhere if prev is None).
+        """
+        bucket = self.count2bucket.get(count)
+        if bucket is not None:
+            return bucket
+        if prev is None:
+            nxt = self.min_bucket
+        else:
+            nxt = prev.next
+        if nxt is not None and nxt.count < count:
+            counts = self.bucket_counts
+            prev = self.count2bucket[counts[bisect_left(counts, count) - 1]]
+        return self._link_after(prev, count)
+
+    def _increment(self, item, amount):
+        old = item.bucket
+        count = item.count + amount
+
+        # Heavy hitters usually sit alone in their bucket, so just relabel it.
+        if len(old.key2item) == 1 and \
+                (old.next is None or count < old.next.count):
+            counts = self.bucket_counts
+            counts[bisect_left(counts, old.count)] = count
+            del self.count2bucket[old.count]
+            self.count2bucket[count] = old
+            old.count = count
+            item.count = count
+            return
+
+        bucket = self._bucket_for(old, count)
+        del old.key2item[item.key]
+        if not old.key2item:
+            self._unlink(old)
+        bucket.key2item[item.key] = item
+        item.bucket = bucket
+        item.count = bucket.count
+
+    def add(self, key, data, weight=1):
+        item = self.key2entry.get(key)
+        if item:
+            item.data = data
+            self._increment(item, weight)
+            if item.count > self._top_floor:
+                self._crossed(key)
+            return
+
+        # Reuse an item from the lowest bucket, renaming it in place so that
+        # _increment() moves it up from there.
         if self.is_full():
-            the_min = self.heap[0].count - 1
+            if self._sketch is not None:
+                weight = self._admit(key, weight)
+                if not weight:
+                    return
+            bucket = self.min_bucket
+            old_key, item = bucket.key2item.popitem()
+            if old_key in self._top_keys:
+                self._reset_top()
+            del self.key2entry[old_key]
+            item.key = key
+            item.data = data
+            item.error = item.count
+            bucket.key2item[key] = item
+            self.key2entry[key] = item
+            self._increment(item, weight)
+            if item.count > self._top_floor:
+                self._crossed(key)
+            return
+
+        floor = self._merged_floor
+        bucket = self._bucket_for(None, floor + weight)
+        item = StreamSummaryItem(key, bucket.count, data, bucket, floor)
+        bucket.key2item[key] = item
+        self.key2entry[key] = item
+        if item.count > self._top_floor:
+            self._crossed(key)
+
+    def _min_count(self):
+        return self.min_bucket.count
+
+    def _largest(self, n):
+        members = []
+        bucket = self.max_bucket
+        while bucket is not None and len(members) < n:
+            for item in bucket.key2item.values():
+                if len(members) >= n:
+                    break
+                members.append(item)
+            bucket = bucket.prev
+        return members
+
+    def _load(self, entries):
+        self._reset_top()
+        self.key2entry = {}
+        self.min_bucket = None
+        self.max_bucket = None
+        self.count2bucket = {}
+        self.bucket_counts = []
+        bucket = None
+        for key, count, data, error in sorted(entries, key=itemgetter(1)):
+            if bucket is None or bucket.count != count:
+                bucket = self._link_after(bucket, count)
+            item = StreamSummaryItem(key, count, data, bucket, error)
+            bucket.key2item[key] = item
+            self.key2entry[key] = item
+
+
+class ArrayItem(object):
+    """
+    Live view of one slot of an ArrayTopTalkerTracker.
+    """
+
+    __slots__ = ('tracker', 'slot')
+
+    def __init__(self, tracker, slot):
+        self.tracker = tracker
+        self.slot = slot
+
+    @property
+    def key(self):
+        return self.tracker.keys[self.slot]
+
+    @property
+    def count(self):
+        return self.tracker.counts[self.slot]
+
+    @property
+    def data(self):
+        return self.tracker.data[self.slot]
+
+    @property
+    def error(self):
+        return self.tracker.errors[self.slot]
+
+
+class ArrayTopTalkerTracker(TopTalkerTracker):
+    """
+    The heap engine without per-entry objects.
+
+    Each key gets a slot: key2entry maps key -> slot, keys and data are lists
+    indexed by slot, and counts, errors, heap (position -> slot) and pos
+    (slot -> position) are typed arrays.  An evicted key's slot goes to its replacement.
+    get() and top_n() hand out ArrayItem views.  Weights must be integers.
+    """
+
+    engine = ENGINE_ARRAY
+
+    def __init__(self, size, engine=ENGINE_ARRAY):
+        TopTalkerTracker.__init__(self, size, engine)
+        self.keys = []
+        self.data = []
+        self.counts = array(COUNT_TYPECODE)
+        self.errors = array(COUNT_TYPECODE)
+        self.heap = array(POS_TYPECODE)
+        self.pos = array(POS_TYPECODE)
+
+    def _swim(self, i):
+        heap = self.heap
+        pos = self.pos
+        counts = self.counts
+        slot = heap[i]
+        count = counts[slot]
+        while i:
+            parent_i = (i - 1) >> 1
+            parent = heap[parent_i]
+            if counts[parent] <= count:
+                break
+            heap[i] = parent
+            pos[parent] = i
+            i = parent_i
+        heap[i] = slot
+        pos[slot] = i
+
+    def _sink(self, i):
+        heap = self.heap
+        pos = self.pos
+        counts = self.counts
+        end = len(heap)
+        slot = heap[i]
+        count = counts[slot]
+        child_i = 2 * i + 1
+        while child_i < end:
+            right_i = child_i + 1
+            if right_i < end and counts[heap[right_i]] < counts[heap[child_i]]:
+                child_i = right_i
+            child = heap[child_i]
+            if count <= counts[child]:
+                break
+            heap[i] = child
+            pos[child] = i
+            i = child_i
+            child_i = 2 * i + 1
+        heap[i] = slot
+        pos[slot] = i
+
+    def get(self, key):
+        return ArrayItem(self, self.key2entry[key])
+
+    def add(self, key, data, weight=1):
+        counts = self.counts
+        slot = self.key2entry.get(key)
+        if slot is not None:
+            counts[slot] += weight
+            self.data[slot] = data
+            self._sink(self.pos[slot])
+            if counts[slot] > self._top_floor:
+                self._crossed(key)
+            return
+
+        if self.is_full():
+            if self._sketch is not None:
+                weight = self._admit(key, weight)
+                if not weight:
+                    return
+            slot = self.heap[0]
+            old_key = self.keys[slot]
+            if old_key in self._top_keys:
+                self._reset_top()
+            del self.key2entry[old_key]
+            self.keys[slot] = key
+            self.data[slot] = data
+            self.errors[slot] = counts[slot]
+            counts[slot] += weight
+            self.key2entry[key] = slot
+            self._sink(0)
+            if counts[slot] > self._top_floor:
+                self._crossed(key)
+            return
+
+        floor = self._merged_floor
+        slot = len(self.keys)
+        self.keys.append(key)
+        self.data.append(data)
+        counts.append(floor + weight)
+        self.errors.append(floor)
+        self.heap.append(slot)
+        self.pos.append(slot)
+        self.key2entry[key] = slot
+        self._swim(slot)
+        if counts[slot] > self._top_floor:
+            self._crossed(key)
+
+    def _min_count(self):
+        return self.counts[self.heap[0]]
+
+    def _largest(self, n):
+        slots = heapq.nlargest(n, range(len(self.keys)),
+                               key=self.counts.__getitem__)
+        return [ArrayItem(self, slot) for slot in slots]
+
+    def _entries(self):
+        return list(zip(self.keys, self.counts, self.data, self.errors))
+
+    def _load(self, entries):
+        # Ascending order is already a valid heap.
+        self._reset_top()
+        entries = sorted(entries, key=itemgetter(1))
+        self.keys = [e[0] for e in entries]
+        self.counts = array(COUNT_TYPECODE, [e[1] for e in entries])
+        self.data = [e[2] for e in entries]
+        self.errors = array(COUNT_TYPECODE, [e[3] for e in entries])
+        self.heap = array(POS_TYPECODE, range(len(entries)))
+        self.pos = array(POS_TYPECODE, range(len(entries)))
+        self.key2entry = dict((key, slot) for slot, key in enumerate(self.keys))
+
+
+ENGINES = {
+    ENGINE_HEAP: HeapTopTalkerTracker,
+    ENGINE_STREAM_SUMMARY: StreamSummaryTopTalkerTracker,
+    ENGINE_ARRAY: ArrayTopTalkerTracker,
+}
+
+
+class WindowedTopTalkerTracker(object):
+    """
+    Top talkers over a sliding window of num_epochs epochs of epoch_seconds.
+
+    Every epoch gets its own Space-Saving summary in a ring.  Epochs that
+    leave the window are simply overwritten, and queries merge the epochs in
+    the window (see merge_entries), so stale keys age out without a clear().
+    """
+
+    def __init__(self, size, epoch_seconds=60, num_epochs=5,
+                 engine=ENGINE_HEAP, clock=time.time):
+        self.size = size
+        self.epoch_seconds = epoch_seconds
+        self.num_epochs = num_epochs
+        self.engine = engine
+        self.clock = clock
+        self.ring = [None] * num_epochs
+
+    def current_epoch(self):
+        return int(self.clock() // self.epoch_seconds)
+
+    def current(self):
+        epoch = self.current_epoch()
+        slot = epoch % self.num_epochs
+        entry = self.ring[slot]
+        if entry is None or entry[0] != epoch:
+            entry = (epoch, TopTalkerTracker(self.size, self.engine))
+            self.ring[slot] = entry
+        return entry[1]
+
+    def add(self, key, data, weight=1):
+        self.current().add(key, data, weight)
+
+    def add_many(self, keys, data=None):
+        self.current().add_many(keys, data)
+
+    def add_counts(self, key2weight):
+        self.current().add_counts(key2weight)
+
+    def window(self, num_epochs=None):
+        """
+        Merged summary of the last num_epochs epochs (default: all of them),
+        the current one included.
+        """
+        if num_epochs is None:
+            num_epochs = self.num_epochs
+        epoch = self.current_epoch()
+        trackers = [t for e, t in filter(None, self.ring)
+                    if epoch - num_epochs < e <= epoch]
+        return TopTalkerTracker.merged(trackers, self.size, self.engine)
+
+    def get(self, key):
+        return self.window().get(key)
+
+    def contains(self, key):
+        return self.window().contains(key)
+
+    def top_n(self, n, num_epochs=None):
+        return self.window(num_epochs).top_n(n)
+
+    def top_n_bounds(self, n, num_epochs=None):
+        return self.window(num_epochs).top_n_bounds(n)
+
+
+def merge_entries(trackers, size):
+    """
+    Mergeable Space-Saving combine -> list of (key, count, data, error).
+
+    A key missing from a full summary may have had up to that summary's
+    minimum count, so it is charged that minimum; every merged count stays an
+    upper bound, off by at most the sum of the inputs' minimums.  Only the
+    size largest survive, and the merged minimum becomes top_n's offset.
+    Data comes from the last tracker that has the key.  A merged error is the
+    sum of the key's errors and of the minimums it was charged.
+    """
+    floors = [t._floor() for t in trackers]
+    total_floor = sum(floors)
+    key2count = {}
+    key2data = {}
+    key2error = {}
+    for t, floor in zip(trackers, floors):
+        for key, count, data, error in t._entries():
+            key2count[key] = key2count.get(key, 0) + count - floor
+            key2data[key] = data
+            key2error[key] = key2error.get(key, 0) + error - floor
+    keys_counts = heapq.nlargest(size, key2count.items(), key=itemgetter(1))
+    return [(key, count + total_floor, key2data[key],
+             key2error[key] + total_floor)
+            for key, count in keys_counts]
+
+
+def from_state(state):
+    version = state[0]
+    if version != STATE_VERSION:
+        raise ValueError('Unsupported tracker state version: %r' % (version,))
+    (version, engine, size, is_saturated, keys, counts, data, errors,
+     floor) = state
+    t = TopTalkerTracker(size, engine)
+    t._load(zip(keys, counts, data, errors))
+    t.is_saturated = is_saturated
+    t._merged_floor = floor
+    return t
+
+
+def fixed_typecode(width, kind):
+    """
+    (width in bytes, 'i' signed / 'u' unsigned / 'f' float) -> array typecode
+    """
+    for typecode in {'i': 'bhilq', 'u': 'BHILQ', 'f': 'fd'}[kind]:
+        try:
+            if array(typecode).itemsize == width:
+                return typecode
+        except ValueError:
+            pass
+    raise ValueError('No %d-byte array typecode' % (width,))
+
+
+def int64_typecode(signed):
+    return fixed_typecode(8, 'i' if signed else 'u')
+
+
+def narrowest_width(values, kind):
+    """
+    -> the fewest bytes (1, 2, 4 or 8) that hold every value of an int kind
+    """
+    lo = min(values) if values else 0
+    hi = max(values) if values else 0
+    for width in (1, 2, 4, 8):
+        if kind == 'i':
+            bound = 1 << (8 * width - 1)
+            if -bound <= lo and hi < bound:
+                return width
+        elif 0 <= lo and hi < 1 << (8 * width):
+            return width
+    raise OverflowError('Values do not fit in 64 bits')
+
+
+def pack_numbers(values, kind):
+    """
+    -> u8 width, then the values as little-endian numbers of that width
+    (floats always take 8 bytes)
+    """
+    width = 8 if kind == 'f' else narrowest_width(values, kind)
+    return struct.pack('<B', width) + pack_array(fixed_typecode(width, kind),
+                                                 values)
+
+
+def unpack_numbers(buf, offset, n, kind):
+    """
+    Read n pack_numbers() values at offset -> (list, new offset)
+    """
+    width, = struct.unpack_from('<B', buf, offset)
+    offset += 1
+    end = offset + width * n
+    values = unpack_array(fixed_typecode(width, kind), buf[offset:end])
+    return values.tolist(), end
+
+
+def pack_array(typecode, values):
+    a = array(typecode, values)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    if hasattr(a, 'tobytes'):
+        return a.tobytes()
+    return a.tostring()
+
+
+def unpack_array(typecode, buf):
+    a = array(typecode)
+    if hasattr(a, 'frombytes'):
+        a.frombytes(buf)
+    else:
+        a.fromstring(buf)
+    if sys.byteorder == 'big':
+        a.byteswap()
+    return a
+
+
+def encode_keys(keys):
+    """
+    keys -> (key kind, bytes): pack_numbers() of integer keys, else
+    pack_numbers() of the keys' lengths followed by the concatenated keys.
+    """
+    if all(isinstance(key, INT_TYPES) and not isinstance(key, bool)
+           for key in keys):
+        if not keys or -(1 << 63) <= min(keys) and max(keys) < (1 << 63):
+            return KEY_INT64, pack_numbers(keys, 'i')
+        if 0 <= min(keys) and max(keys) < (1 << 64):
+            return KEY_UINT64, pack_numbers(keys, 'u')
+
+    if all(isinstance(key, bytes) for key in keys):
+        kind = KEY_BYTES
+        blobs = keys
+    elif all(isinstance(key, type(u'')) for key in keys):
+        kind = KEY_TEXT
+        blobs = [key.encode('utf-8') for key in keys]
+    else:
+        raise TypeError('Snapshots need all-int, all-bytes or all-text keys; '
+                        'use dumps() for anything else')
+
+    return kind, (pack_numbers([len(blob) for blob in blobs], 'u') +
+                  b''.join(blobs))
+
+
+def decode_keys(buf, offset, n, kind):
+    """
+    Read n encode_keys() keys at offset -> (keys, new offset)
+    """
+    if kind in (KEY_INT64, KEY_UINT64):
+        return unpack_numbers(buf, offset, n,
+                              'i' if kind == KEY_INT64 else 'u')
+
+    lengths, offset = unpack_numbers(buf, offset, n, 'u')
+    offsets = [0]
+    for length in lengths:
+        offsets.append(offsets[-1] + length)
+    blob = buf[offset:offset + offsets[-1]]
+    offset += offsets[-1]
+    if kind == KEY_TEXT:
+        text = blob.decode('utf-8')
+        # Byte offsets are character offsets too when the keys are ASCII.
+        if len(text) == len(blob):
+            return [text[offsets[i]:offsets[i + 1]] for i in range(n)], offset
+    keys = [blob[offsets[i]:offsets[i + 1]] for i in range(n)]
+    if kind == KEY_TEXT:
+        keys = [key.decode('utf-8') for key in keys]
+    return keys, offset
+
+
+def write_snapshot(path, engine, size, is_saturated, entries, floor=0):
+    """
+    Snapshot layout, all little-endian:
+
+        header    magic 'TTKR', version u16, flags u16, size u64, n u64,
+                  engine name (16 bytes, NUL padded)
+        key kind  u8
+        floor     int64 (float64 with SNAPSHOT_FLOAT_COUNTS), only with
+                  SNAPSHOT_HAS_FLOOR
+        counts    pack_numbers() of ints (floats with SNAPSHOT_FLOAT_COUNTS)
+        errors    the same, only with SNAPSHOT_HAS_ERRORS (else all 0)
+        keys      see encode_keys()
+        data      pickled list, only with SNAPSHOT_HAS_DATA
+
+    Counts, integer keys and key lengths take the fewest bytes that hold
+    them, so a table of IPv4 strings costs about as much as its text plus a
+    few bytes per entry.  The file is written next to path and renamed over
+    it.
+    """
+    keys = [e[0] for e in entries]
+    counts = [e[1] for e in entries]
+    data = [e[2] for e in entries]
+    errors = [e[3] for e in entries]
+
+    flags = 0
+    if is_saturated:
+        flags |= SNAPSHOT_SATURATED
+    if all(isinstance(count, INT_TYPES)
+           for count in counts + errors + [floor]):
+        kind = 'i'
+    else:
+        flags |= SNAPSHOT_FLOAT_COUNTS
+        kind = 'f'
+    counts_bytes = pack_numbers(counts, kind)
+    if any(errors):
+        flags |= SNAPSHOT_HAS_ERRORS
+        counts_bytes += pack_numbers(errors, kind)
+    if floor:
+        flags |= SNAPSHOT_HAS_FLOOR
+        counts_bytes = pack_array(fixed_typecode(8, kind), [floor]) + \
+            counts_bytes
+    if any(datum is not None for datum in data):
+        flags |= SNAPSHOT_HAS_DATA
+    key_kind, keys_bytes = encode_keys(keys)
+
+    header = SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, size,
+                                  len(entries), engine.encode('ascii'))
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            out.write(header)
+            out.write(struct.pack('<B', key_kind))
+            out.write(counts_bytes)
+            out.write(keys_bytes)
+            if flags & SNAPSHOT_HAS_DATA:
+                pickle.dump(data, out, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+
+class SnapshotWriter(threading.Thread):
+    """
+    Runs write_snapshot(*args).  join() re-raises its exception, if any; it
+    is also kept in .error.
+    """
+
+    def __init__(self, args):
+        threading.Thread.__init__(self)
+        self.args = args
+        self.error = None
+
+    def run(self):
+        try:
+            write_snapshot(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def join(self, timeout=None):
+        threading.Thread.join(self, timeout)
+        if self.error is not None and not self.is_alive():
+            raise self.error
+
+
+def read_snapshot(path):
+    """
+    Load a tracker from a write_snapshot() file, reading it through mmap.
+
+    Decoding is a small part of a load; rebuilding the engine from the
+    entries costs the same as it does for loads().
+    """
+    with open(path, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, flags, size, n, engine = \
+            SNAPSHOT_HEADER.unpack_from(buf, 0)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a tracker snapshot: %r' % (path,))
+        if version != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version: %r' % (version,))
+        if flags & ~SNAPSHOT_FLAGS:
+            raise ValueError('Unsupported snapshot flags: %r' % (flags,))
+        engine = engine.rstrip(b'\0').decode('ascii')
+        offset = SNAPSHOT_HEADER.size
+        key_kind, = struct.unpack_from('<B', buf, offset)
+        offset += 1
+
+        kind = 'f' if flags & SNAPSHOT_FLOAT_COUNTS else 'i'
+        floor = 0
+        if flags & SNAPSHOT_HAS_FLOOR:
+            floor, = unpack_array(fixed_typecode(8, kind),
+                                  buf[offset:offset + 8]).tolist()
+            offset += 8
+        counts, offset = unpack_numbers(buf, offset, n, kind)
+        if flags & SNAPSHOT_HAS_ERRORS:
+            errors, offset = unpack_numbers(buf, offset, n, kind)
         else:
-            the_min = 0
-        return map(lambda m:
-            TopTalkerTrackerItem(m.key, m.count - the_min, m.data), members)
+            errors = [0] * n
+
+        keys, offset = decode_keys(buf, offset, n, key_kind)
+
+        if flags & SNAPSHOT_HAS_DATA:
+            data = pickle.loads(buf[offset:])
+        else:
+            data = [None] * n
+    finally:
+        buf.close()
+
+    t = TopTalkerTracker(size, engine)
+    t._load(zip(keys, counts, data, errors))
+    t.is_saturated = bool(flags & SNAPSHOT_SATURATED)
+    t._merged_floor = floor
+    return t
+
+
+def check_space_saving(t, exact):
+    """
+    Check a tracker against the exact counts of the stream it was fed.
+    """
+    total = sum(exact.values())
+    counts = dict((key, count) for key, count, data, error in t._entries())
+    assert sum(counts.values()) == total
+    if len(exact) <= t.size:
+        assert counts == exact
+        return
+
+    the_min = t._min_count()
+    assert the_min * t.size <= total
+    for key, count in counts.items():
+        assert exact.get(key, 0) <= count <= exact.get(key, 0) + the_min
+    for key, count, data, error in t._entries():
+        assert count - error <= exact.get(key, 0) and error <= the_min
+    for key, count in exact.items():
+        if count > the_min:
+            assert key in counts
+
+
+def random_stream(rng, size):
+    num_keys = rng.randint(1, 3 * size)
+    return [int(rng.paretovariate(1.2)) % num_keys
+            for i in range(rng.randint(0, 1000))]
+
+
+def check_engines_agree(trials=200, seed=0):
+    """
+    Feed the same random skewed streams to every engine, half of them with
+    byte-like weights.
+
+    While nothing is evicted the engines must agree exactly.  Once full, the
+    victim among tied minimums is engine-specific, so instead check that each
+    engine upholds the Space-Saving guarantees against the exact counts.
+    """
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        trackers = [TopTalkerTracker(size, engine) for engine in sorted(ENGINES)]
+        weights = [1] if trial % 2 else [1, 40, 576, 1500]
+        exact = Counter()
+        for i, key in enumerate(random_stream(rng, size)):
+            weight = rng.choice(weights)
+            exact[key] += weight
+            for t in trackers:
+                t.add(key, i, weight)
+            assert len(set(t.is_full() for t in trackers)) == 1
+
+        for t in trackers:
+            check_space_saving(t, exact)
+            if t.engine == ENGINE_STREAM_SUMMARY:
+                counts = []
+                bucket = t.min_bucket
+                while bucket is not None:
+                    assert t.count2bucket[bucket.count] is bucket
+                    counts.append(bucket.count)
+                    bucket = bucket.next
+                assert counts == t.bucket_counts == sorted(t.count2bucket)
+            if len(exact) <= size:
+                for key in exact:
+                    assert t.get(key).data == trackers[0].get(key).data
+
+
+def check_add_many(trials=200, seed=0):
+    """
+    Batched adds must keep the Space-Saving guarantees, and match sequential
+    adds exactly (data included) while nothing is evicted.
+    """
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        stream = random_stream(rng, size)
+        for engine in sorted(ENGINES):
+            batched = TopTalkerTracker(size, engine)
+            i = 0
+            while i < len(stream):
+                j = i + rng.randint(1, 200)
+                batched.add_many(iter(stream[i:j]), range(i, j))
+                i = j
+
+            check_space_saving(batched, Counter(stream))
+            if len(set(stream)) <= size:
+                sequential = TopTalkerTracker(size, engine)
+                for i, key in enumerate(stream):
+                    sequential.add(key, i)
+                for key in stream:
+                    assert batched.get(key).data == sequential.get(key).data
+
+
+def check_merge(trials=100, seed=0):
+    """
+    Merged shard summaries must bound the exact counts of the whole stream and
+    survive a round trip through dumps()/loads() and pickle.
+    """
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        stream = random_stream(rng, size)
+        num_shards = rng.randint(1, 4)
+        for engine in sorted(ENGINES):
+            shards = [TopTalkerTracker(size, engine)
+                      for i in range(num_shards)]
+            for i, key in enumerate(stream):
+                shards[rng.randrange(num_shards)].add(key, i)
+            total_floor = sum(t._floor() for t in shards)
+
+            shards = [TopTalkerTracker.loads(t.dumps()) for t in shards]
+            t = TopTalkerTracker.merged(shards, size, engine)
+            t = pickle.loads(pickle.dumps(t, pickle.HIGHEST_PROTOCOL))
+            assert t.engine == engine
+
+            exact = Counter(stream)
+            for key, count, data, error in t._entries():
+                assert exact[key] <= count <= exact[key] + total_floor
+                assert count - error <= exact[key]
+            for key, count in exact.items():
+                if count > t._floor():
+                    assert t.contains(key)
+            if len(exact) <= size:
+                assert dict((e[0], e[1]) for e in t._entries()) == exact
+
+
+def check_merge_larger(trials=100, seed=0):
+    """
+    Full summaries merged into a larger size must keep charging missing keys
+    their inputs' minimums, in bounds, top_n() and later adds and merges.
+    """
+    for engine in sorted(ENGINES):
+        a = TopTalkerTracker(1, engine)
+        for key in 'xxxxxy':
+            a.add(key, None)
+        b = TopTalkerTracker(1, engine)
+        b.add('z', None)
+        t = TopTalkerTracker.merged([a, b], 10, engine)
+        assert not t.is_full() and t._floor() == 7
+        assert [bound[3] for bound in t.top_n_bounds(2)] == [False, False]
+        t.add('x', None)
+        assert t.get('x').count == 8
+
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 16)
+        stream = random_stream(rng, size)
+        split = rng.randint(0, len(stream))
+        for engine in sorted(ENGINES):
+            shards = [TopTalkerTracker(size, engine) for i in range(2)]
+            for key in stream[:split]:
+                shards[rng.randrange(2)].add(key, None)
+            t = TopTalkerTracker.merged(shards, 3 * size, engine)
+            t = TopTalkerTracker.loads(t.dumps())
+            for key in stream[split:]:
+                t.add(key, None)
+
+            exact = Counter(stream)
+            for key, count, data, error in t._entries():
+                assert count - error <= exact[key] <= count
+            for key, count in exact.items():
+                if count > t._floor():
+                    assert t.contains(key)
+            bounds = t.top_n_bounds(size)
+            rest = max([count for key, count in exact.items()
+                        if key not in set(b[0] for b in bounds)] or [0])
+            for key, count, error, guaranteed in bounds:
+                if guaranteed:
+                    assert exact[key] >= rest
+
+
+def check_top_n_cache(trials=100, seed=0):
+    """
+    Interleave adds with top_n queries of varying n; every answer must match
+    one computed from scratch.
+    """
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        for engine in sorted(ENGINES):
+            t = TopTalkerTracker(size, engine)
+            for i, key in enumerate(random_stream(rng, size)):
+                t.add(key, i, rng.choice([1, 1, 1, 5]))
+                if rng.random() < 0.2:
+                    n = rng.randint(0, size + 2)
+                    got = t.top_n(n)
+                    if t.is_full():
+                        the_min = t._min_count() - 1
+                    else:
+                        the_min = 0
+                    counts = sorted((e[1] for e in t._entries()),
+                                    reverse=True)
+                    assert [a.count for a in got] == \
+                        [count - the_min for count in counts[:n]]
+                    for a in got:
+                        assert t.get(a.key).count - the_min == a.count
+
+
+def check_bounds(trials=200, seed=0):
+    """
+    top_n_bounds() must bracket the exact counts, and a guaranteed key must
+    count at least as much as every key it was not compared against.
+    """
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        stream = random_stream(rng, size)
+        weights = [rng.choice([1, 1, 1, 5]) for key in stream]
+        exact = Counter()
+        for key, weight in zip(stream, weights):
+            exact[key] += weight
+        for engine in sorted(ENGINES):
+            t = TopTalkerTracker(size, engine)
+            for key, weight in zip(stream, weights):
+                t.add(key, None, weight)
+            n = rng.randint(1, size)
+            bounds = t.top_n_bounds(n)
+            assert [b[1] for b in bounds] == \
+                sorted((e[1] for e in t._entries()), reverse=True)[:n]
+            returned = set(b[0] for b in bounds)
+            rest = max([count for key, count in exact.items()
+                        if key not in returned] or [0])
+            for key, count, error, guaranteed in bounds:
+                assert count - error <= exact[key] <= count
+                if guaranteed:
+                    assert exact[key] >= rest
+
+    # Skewed traffic: a small table still pins down its top 10.
+    rng = random.Random(seed)
+    t = TopTalkerTracker(100)
+    for i in range(10000):
+        t.add(int(rng.paretovariate(1.2)), None)
+    assert t.is_full()
+    assert all(b[3] for b in t.top_n_bounds(10))
+
+
+def check_snapshot(trials=30, seed=0):
+    """
+    save()/load() must round-trip every engine's entries and saturation, for
+    each kind of key.
+    """
+    rng = random.Random(seed)
+    make_keys = [
+        lambda key: key,
+        lambda key: key + (1 << 63),
+        lambda key: ('k%d' % key).encode('ascii'),
+        lambda key: u'\u043a%d' % key,
+    ]
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'tracker.snapshot')
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        stream = random_stream(rng, size)
+        make_key = rng.choice(make_keys)
+        with_data = rng.random() < 0.5
+        weight = rng.choice([1, 2.5])
+        for engine in sorted(ENGINES):
+            if engine == ENGINE_ARRAY and weight != 1:
+                continue
+            t = TopTalkerTracker(size, engine)
+            for i, key in enumerate(stream):
+                t.add(make_key(key), i if with_data else None, weight)
+            if rng.random() < 0.5:
+                t.save(path)
+            else:
+                t.save(path, background=True).join()
+            loaded = TopTalkerTracker.load(path)
+            assert loaded.engine == engine
+            assert loaded.is_full() == t.is_full()
+            assert sorted(loaded._entries()) == sorted(t._entries())
+
+    t = TopTalkerTracker(4)
+    t.add(('not', 'snapshottable'), None)
+    writer = t.save(path, background=True)
+    try:
+        writer.join()
+    except TypeError:
+        pass
+    else:
+        raise AssertionError('background save swallowed its error')
+    assert isinstance(writer.error, TypeError)
+
+    os.remove(path)
+    os.rmdir(tmp_dir)
+
+
+def check_stats():
+    t = TopTalkerTracker(2)
+    t.add('cat', None)
+    assert 'adds' not in t.stats()
+
+    t.enable_stats()
+    for key in ['cat', 'dog', 'cat', 'llama']:
+        t.add(key, None)
+    t.add_many(['dog', 'dog', 'mouse'])
+    stats = t.stats()
+    assert (stats['adds'], stats['hits'], stats['inserts'],
+            stats['evictions']) == (6, 2, 1, 3)
+    assert stats['tracked'] == 2
+    assert stats['is_full']
+    assert stats['min_count'] == t._min_count()
+
+    t.disable_stats()
+    assert 'add' not in t.__dict__
+    t.add('cat', None)
+    assert 'adds' not in t.stats()
+
+
+def check_admission(size=100, num_adds=100000, seed=0):
+    """
+    On a long tail, admission should cut evictions sharply without losing
+    the heavy hitters.
+    """
+    rng = random.Random(seed)
+    stream = [rng.randrange(10) if rng.random() < 0.2
+              else rng.randrange(10, 1000000) for i in range(num_adds)]
+    for engine in sorted(ENGINES):
+        plain = TopTalkerTracker(size, engine)
+        gated = TopTalkerTracker(size, engine)
+        gated.enable_admission()
+        for t in (plain, gated):
+            t.enable_stats()
+            for key in stream:
+                t.add(key, None)
+        plain_stats = plain.stats()
+        gated_stats = gated.stats()
+        assert gated_stats['evictions'] * 5 < plain_stats['evictions']
+        assert gated_stats['rejections'] > 0
+        assert sorted(a.key for a in gated.top_n(10)) == list(range(10))
+
+
+def check_windowed():
+    now = [0]
+    t = WindowedTopTalkerTracker(4, epoch_seconds=60, num_epochs=2,
+                                 clock=lambda: now[0])
+    t.add('cat', 1, 3)
+    t.add('dog', 2)
+    now[0] = 60
+    t.add_many(['dog', 'dog', 'dog', 'llama'])
+    assert [(a.key, a.count) for a in t.top_n(3)] == \
+        [('dog', 4), ('cat', 3), ('llama', 1)]
+    assert [(a.key, a.count) for a in t.top_n(3, num_epochs=1)] == \
+        [('dog', 3), ('llama', 1)]
+    assert t.get('dog').count == 4
+    now[0] = 120
+    assert not t.contains('cat')
+    assert [(a.key, a.count) for a in t.top_n(3)] == \
+        [('dog', 3), ('llama', 1)]
+
+
+def check_add_array(trials=50, seed=0):
+    """
+    add_array() must agree with add_many() on the same batches.
+    """
+    if np is None:
+        print('check_add_array: needs numpy, skipped')
+        return
+
+    rng = random.Random(seed)
+    for trial in range(trials):
+        size = rng.randint(1, 32)
+        stream = random_stream(rng, size)
+        weights = [rng.randint(1, 1500) for key in stream]
+        for engine in sorted(ENGINES):
+            t = TopTalkerTracker(size, engine)
+            t.add_array(np.array(stream, dtype=np.uint32))
+            check_space_saving(t, Counter(stream))
+
+            t = TopTalkerTracker(size, engine)
+            t.add_array(np.array(stream, dtype=np.uint32),
+                        np.array(weights, dtype=np.int64))
+            exact = Counter()
+            for key, weight in zip(stream, weights):
+                exact[key] += weight
+            check_space_saving(t, exact)
+
+            keys, counts = t.top_n_arrays(5)
+            assert keys.dtype == np.uint32
+            assert list(zip(keys.tolist(), counts.tolist())) == \
+                [(a.key, a.count) for a in t.top_n(5)]
+
+
+def bench_memory(size=16384):
+    """
+    Print the bytes each engine allocates per tracked key, not counting the
+    keys themselves.  Needs tracemalloc (Python 3).
+    """
+    if tracemalloc is None:
+        print('bench_memory: tracemalloc needs Python 3, skipped')
+        return
+
+    keys = ['10.0.%d.%d' % (i >> 8, i & 255) for i in range(size)]
+    for engine in sorted(ENGINES):
+        tracemalloc.start()
+        t = TopTalkerTracker(size, engine)
+        for key in keys:
+            t.add(key, None)
+        num_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print('%-16s %6.1f bytes/key' % (engine, float(num_bytes) / size))
 
 
 def main():
     t = TopTalkerTracker(16384)
     t.add('cat', 1389235982398)
-    print map(lambda a: a.key, t.top_n(5))
+    print([a.key for a in t.top_n(5)])
     t.add('dog', 39013923592)
     t.add('cat', 1389235982398)
-    print map(lambda a: a.key, t.top_n(5))
+    print([a.key for a in t.top_n(5)])
     t.add('parrot', 23901)
     t.add('mouse', 1091091)
     t.add('cow', 20912901)
     t.add('horse', 149014901)
-    print map(lambda a: a.key, t.top_n(5))
-    print t.get('cat').count
-    print t.get('horse').count
+    print([a.key for a in t.top_n(5)])
+    print(t.get('cat').count)
+    print(t.get('horse').count)
+
+    check_engines_agree()
+    check_add_many()
+    check_merge()
+    check_merge_larger()
+    check_top_n_cache()
+    check_bounds()
+    check_snapshot()
+    check_stats()
+    check_admission()
+    check_windowed()
+    check_add_array()
+
+    bench_memory()
 
 
 if __name__ == '__main__':
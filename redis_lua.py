@@ -1,4 +1,70 @@
+from collections import Counter
+import hashlib
+from operator import itemgetter
+import random
+import struct
+import time
+
 from redis import StrictRedis
+from redis.exceptions import ResponseError
+
+from cache import (
+    CACHE_ENTRIES, CACHE_TTL, ReadCache, cached_script, subscribe_invalidations)
+from stats import instrument, snapshot_latencies, uninstrument
+
+
+# Distinct keys per LUA_ADD_MANY call, to bound how long one script blocks Redis.
+ADD_MANY_CHUNK = 1000
+
+# Rows per page of iter_keys_counts(), for the same reason.
+EXPORT_CHUNK = 1000
+
+# What one add did, as returned by add_one() in the scripts.
+OUTCOME_HIT = 0
+OUTCOME_INSERT = 1
+OUTCOME_EVICTION = 2
+OUTCOME_REJECTION = 3
+
+# A table's admission sketch (see TopTalkers) is the string "<table>:sketch".
+SKETCH_SUFFIX = ':sketch'
+
+# The hash "<table>:errors" maps each member that evicted another to its error,
+# the count it took over (see TopTalkers.top_n_bounds).  Other members have
+# error 0.
+ERRORS_SUFFIX = ':errors'
+
+# Calls timed once stats are enabled (add_many is timed as add_counts).
+STATS_METHODS = ['clear', 'is_full', 'get', 'contains', 'add', 'add_counts',
+                 'add_multi_table', 'top_n_keys', 'top_n_keys_counts',
+                 'top_n_bounds', 'top_n_many']
+
+
+def script_table(keys):
+    """
+    KEYS of a single-table script -> [the table], its first key
+    """
+    return keys[:1]
+
+
+def window_table(keys):
+    """
+    KEYS of a merged script (size, n or key, then '<table>:<epoch>' tables)
+    -> [the table], whose sub-keys the epochs are
+    """
+    return [keys[2].rsplit(':', 1)[0]]
+
+
+# Read scripts answered from the client-side cache once it is enabled, and
+# how to tell the tables they read from their KEYS.
+CACHED_SCRIPTS = {
+    '_get': script_table,
+    '_top_n_keys': script_table,
+    '_top_n_keys_counts': script_table,
+    '_top_n_bounds': script_table,
+    '_get_merged': window_table,
+    '_top_n_keys_counts_merged': window_table,
+    '_top_n_bounds_merged': window_table,
+}
 
 
 LUA_IS_FULL_INNER = """
@@ -23,27 +89,135 @@ return redis.call('zscore', table, key)
 """
 
 
-LUA_ADD = """
+# Defines add_one(), shared by the single and bulk add scripts.  It returns one
+# of the OUTCOME_* codes.  An evicting key's error is the count it took over.
+LUA_ADD_ONE = """
+local function add_one(table, size, errors, key, weight)
+    local count = redis.call('zscore', table, key)
+    if count ~= false then
+        redis.call('zincrby', table, weight, key)
+        return 0
+    end
+
+    if redis.call('zcard', table) >= size then
+        local keys_counts = redis.call('zrange', table, 0, 0, 'withscores')
+        local old_count = tonumber(keys_counts[2])
+        redis.call('zremrangebyrank', table, 0, 0)
+        redis.call('hdel', errors, keys_counts[1])
+        local new_count = old_count + weight
+        redis.call('zadd', table, new_count, key)
+        redis.call('hset', errors, key, old_count)
+        return 2
+    end
+
+    redis.call('zadd', table, weight, key)
+    return 1
+end
+"""
+
+
+# Defines add_one_gated(): add_one() with a Count-Min sketch admission gate.
+# The sketch is a string of u32 counters updated with BITFIELD, and slots are
+# the key's counter indices, one per row, hashed client-side by sketch_slots().
+LUA_ADD_ONE_GATED = """
+local function add_one_gated(table, size, errors, key, weight, sketch, slots)
+    local count = redis.call('zscore', table, key)
+    if count ~= false then
+        redis.call('zincrby', table, weight, key)
+        return 0
+    end
+
+    if redis.call('zcard', table) >= size then
+        local keys_counts = redis.call('zrange', table, 0, 0, 'withscores')
+        local old_count = tonumber(keys_counts[2])
+
+        local args = {'overflow', 'sat'}
+        for i = 1, #slots do
+            args[#args + 1] = 'incrby'
+            args[#args + 1] = 'u32'
+            args[#args + 1] = '#' .. slots[i]
+            args[#args + 1] = math.ceil(weight)
+        end
+        local counts = redis.call('bitfield', sketch, unpack(args))
+        local estimate = counts[1]
+        for i = 2, #counts do
+            estimate = math.min(estimate, counts[i])
+        end
+        if estimate <= old_count then
+            return 3
+        end
+
+        redis.call('zremrangebyrank', table, 0, 0)
+        redis.call('hdel', errors, keys_counts[1])
+        local new_count = math.max(old_count + weight, estimate)
+        redis.call('zadd', table, new_count, key)
+        redis.call('hset', errors, key, old_count)
+        return 2
+    end
+
+    redis.call('zadd', table, weight, key)
+    return 1
+end
+"""
+
+
+LUA_ADD = LUA_ADD_ONE + """
 local table = KEYS[1]
 local size = tonumber(KEYS[2])
-local key = KEYS[3]
+local errors = KEYS[3]
+local key = KEYS[4]
+local weight = tonumber(KEYS[5])
 
-local count = redis.call('zscore', table, key)
-if count ~= false then
-    redis.call('zincrby', table, 1, key)
-    return
-end
+return add_one(table, size, errors, key, weight)
+"""
 
-if redis.call('zcard', table) >= size then
-    local keys_counts = redis.call('zrange', table, 0, 0, 'withscores')
-    local old_count = tonumber(keys_counts[2])
-    redis.call('zremrangebyrank', table, 0, 0)
-    local new_count = old_count + 1
-    redis.call('zadd', table, new_count, key)
-    return
+
+# KEYS: table, size, errors, then key and weight per key.
+LUA_ADD_MANY = LUA_ADD_ONE + """
+local table = KEYS[1]
+local size = tonumber(KEYS[2])
+local errors = KEYS[3]
+
+local outcomes = {0, 0, 0, 0}
+for i = 4, #KEYS, 2 do
+    local outcome = add_one(
+        table, size, errors, KEYS[i], tonumber(KEYS[i + 1])) + 1
+    outcomes[outcome] = outcomes[outcome] + 1
 end
+return outcomes
+"""
 
-redis.call('zadd', table, 1, key)
+
+LUA_ADD_GATED = LUA_ADD_ONE_GATED + """
+local table = KEYS[1]
+local size = tonumber(KEYS[2])
+local errors = KEYS[3]
+local key = KEYS[4]
+local weight = tonumber(KEYS[5])
+local sketch = KEYS[6]
+
+return add_one_gated(
+    table, size, errors, key, weight, sketch, {unpack(KEYS, 7)})
+"""
+
+
+# KEYS: table, size, errors, sketch, depth, then key, weight and depth slots
+# per key.
+LUA_ADD_MANY_GATED = LUA_ADD_ONE_GATED + """
+local table = KEYS[1]
+local size = tonumber(KEYS[2])
+local errors = KEYS[3]
+local sketch = KEYS[4]
+local depth = tonumber(KEYS[5])
+
+local outcomes = {0, 0, 0, 0}
+for i = 6, #KEYS, 2 + depth do
+    local slots = {unpack(KEYS, i + 2, i + 1 + depth)}
+    local outcome = add_one_gated(table, size, errors, KEYS[i],
+                                  tonumber(KEYS[i + 1]), sketch, slots) + 1
+    outcomes[outcome] = outcomes[outcome] + 1
+end
+return outcomes
 """
 
 
@@ -76,16 +250,415 @@ return keys_counts
 """
 
 
+# Returns key, count, error and guaranteed (0 or 1) per row.  A row is
+# guaranteed when count - error, the least its key can have, is at least the
+# count of the next row, or of the minimum (if full) that bounds untracked keys.
+LUA_TOP_N_BOUNDS = """
+local table = KEYS[1]
+local size = tonumber(KEYS[2])
+local errors = KEYS[3]
+local n = tonumber(KEYS[4])
+
+local keys_counts = redis.call('zrevrange', table, 0, n, 'withscores')
+local threshold = 0
+if #keys_counts > 2 * n then
+    threshold = tonumber(keys_counts[2 * n + 2])
+elseif redis.call('zcard', table) >= size then
+    local lowest_keys_counts = redis.call('zrange', table, 0, 0, 'withscores')
+    threshold = tonumber(lowest_keys_counts[2])
+end
+local bounds = {}
+for i = 1, math.min(n, #keys_counts / 2) do
+    local key = keys_counts[2 * i - 1]
+    local count = tonumber(keys_counts[2 * i])
+    local err = tonumber(redis.call('hget', errors, key)) or 0
+    bounds[#bounds + 1] = key
+    bounds[#bounds + 1] = count
+    bounds[#bounds + 1] = err
+    bounds[#bounds + 1] = (count - err >= threshold) and 1 or 0
+end
+return bounds
+"""
+
+
+# The offset top_n_keys_counts() takes off every count: the minimum count less
+# one if the table is full, else 0.
+LUA_MIN_OFFSET = """
+local table = KEYS[1]
+local size = tonumber(KEYS[2])
+
+if redis.call('zcard', table) < size then
+    return 0
+end
+local lowest_keys_counts = redis.call('zrange', table, 0, 0, 'withscores')
+return tonumber(lowest_keys_counts[2]) - 1
+"""
+
+
+# Merges several tables (e.g. the epochs of a window) the way local.py's
+# merge_entries() does: a key missing from a full table is charged that table's
+# minimum, and the merged table keeps the size largest.  A size of 0 means the
+# tables are treated as never full.  KEYS: size, n or key, then the tables.
+#
+# Every merged query reads every row of every table and runs as one script,
+# so it blocks the server for num_tables * size rows (about 80k for 5 epochs
+# of 16384).  Nothing is precomputed between queries.
+LUA_MERGE = """
+local size = tonumber(KEYS[1])
+
+local key2count = {}
+local keys = {}
+local total_floor = 0
+for i = 3, #KEYS do
+    local epoch_table = KEYS[i]
+    local floor = 0
+    if size > 0 and redis.call('zcard', epoch_table) >= size then
+        local lowest_keys_counts = redis.call(
+            'zrange', epoch_table, 0, 0, 'withscores')
+        floor = tonumber(lowest_keys_counts[2])
+    end
+    total_floor = total_floor + floor
+
+    local keys_counts = redis.call('zrange', epoch_table, 0, -1, 'withscores')
+    for j = 1, #keys_counts, 2 do
+        local key = keys_counts[j]
+        local count = tonumber(keys_counts[j + 1]) - floor
+        if key2count[key] == nil then
+            key2count[key] = count
+            keys[#keys + 1] = key
+        else
+            key2count[key] = key2count[key] + count
+        end
+    end
+end
+"""
+LUA_TOP_N_KEYS_COUNTS_MERGED = LUA_MERGE + """
+local n = tonumber(KEYS[2])
+
+table.sort(keys, function(a, b)
+    if key2count[a] ~= key2count[b] then
+        return key2count[a] > key2count[b]
+    end
+    return a > b
+end)
+
+local the_min = 0
+if size > 0 and #keys >= size then
+    the_min = key2count[keys[size]] + total_floor - 1
+    n = math.min(n, size)
+elseif total_floor > 0 then
+    the_min = total_floor - 1
+end
+local keys_counts = {}
+for i = 1, math.min(n, #keys) do
+    keys_counts[#keys_counts + 1] = keys[i]
+    keys_counts[#keys_counts + 1] = key2count[keys[i]] + total_floor - the_min
+end
+return keys_counts
+"""
+
+# One key's merged count, or nil if the merge into size drops it.  Ties rank
+# as in LUA_TOP_N_KEYS_COUNTS_MERGED.
+LUA_GET_MERGED = LUA_MERGE + """
+local key = KEYS[2]
+local count = key2count[key]
+if count == nil then
+    return false
+end
+if size > 0 and #keys > size then
+    local ahead = 0
+    for i = 1, #keys do
+        local other = keys[i]
+        local other_count = key2count[other]
+        if other_count > count or (other_count == count and other > key) then
+            ahead = ahead + 1
+        end
+    end
+    if ahead >= size then
+        return false
+    end
+end
+return count + total_floor
+"""
+
+
+# LUA_TOP_N_BOUNDS over merged tables.  KEYS: size, n, then each table and its
+# errors hash.  A merged error is the sum of the key's errors and of the
+# minimums it was charged, as in local.py's merge_entries().
+LUA_TOP_N_BOUNDS_MERGED = """
+local size = tonumber(KEYS[1])
+local n = tonumber(KEYS[2])
+
+local key2count = {}
+local key2error = {}
+local keys = {}
+local total_floor = 0
+for i = 3, #KEYS, 2 do
+    local epoch_table = KEYS[i]
+    local errors = KEYS[i + 1]
+    local floor = 0
+    if size > 0 and redis.call('zcard', epoch_table) >= size then
+        local lowest_keys_counts = redis.call(
+            'zrange', epoch_table, 0, 0, 'withscores')
+        floor = tonumber(lowest_keys_counts[2])
+    end
+    total_floor = total_floor + floor
+
+    local keys_counts = redis.call('zrange', epoch_table, 0, -1, 'withscores')
+    local keys_errors = redis.call('hgetall', errors)
+    local epoch_key2error = {}
+    for j = 1, #keys_errors, 2 do
+        epoch_key2error[keys_errors[j]] = tonumber(keys_errors[j + 1])
+    end
+    for j = 1, #keys_counts, 2 do
+        local key = keys_counts[j]
+        local count = tonumber(keys_counts[j + 1]) - floor
+        local err = (epoch_key2error[key] or 0) - floor
+        if key2count[key] == nil then
+            key2count[key] = count
+            key2error[key] = err
+            keys[#keys + 1] = key
+        else
+            key2count[key] = key2count[key] + count
+            key2error[key] = key2error[key] + err
+        end
+    end
+end
+
+table.sort(keys, function(a, b)
+    if key2count[a] ~= key2count[b] then
+        return key2count[a] > key2count[b]
+    end
+    return a > b
+end)
+
+local threshold = total_floor
+if size > 0 and #keys >= size and n >= size then
+    n = size
+    threshold = key2count[keys[size]] + total_floor
+elseif #keys > n then
+    threshold = key2count[keys[n + 1]] + total_floor
+end
+local bounds = {}
+for i = 1, math.min(n, #keys) do
+    local count = key2count[keys[i]] + total_floor
+    local err = key2error[keys[i]] + total_floor
+    bounds[#bounds + 1] = keys[i]
+    bounds[#bounds + 1] = count
+    bounds[#bounds + 1] = err
+    bounds[#bounds + 1] = (count - err >= threshold) and 1 or 0
+end
+return bounds
+"""
+
+
+def pairs_from_flat(rr):
+    """
+    [key, count, key, count, ...] -> list of (key, count)
+    """
+    pairs = []
+    for i in range(len(rr) // 2):
+        pair = (rr[i * 2], int(rr[i * 2 + 1]))
+        pairs.append(pair)
+    return pairs
+
+
+def bounds_from_flat(rr):
+    """
+    [key, count, error, guaranteed, ...] -> list of
+    (key, count, error, guaranteed)
+    """
+    bounds = []
+    for i in range(0, len(rr), 4):
+        bounds.append((rr[i], int(rr[i + 1]), int(rr[i + 2]),
+                       bool(rr[i + 3])))
+    return bounds
+
+
+def sum_outcomes(rr):
+    """
+    LUA_ADD_MANY replies -> [hits, inserts, evictions, rejections]
+    """
+    outcomes = [0, 0, 0, 0]
+    for r in rr:
+        for i in range(4):
+            outcomes[i] += r[i]
+    return outcomes
+
+
+def key_bytes(key):
+    if isinstance(key, bytes):
+        return key
+    if not isinstance(key, type(u'')):
+        key = str(key)
+    return key.encode('utf-8')
+
+
+def sketch_slots(key, width, depth):
+    """
+    -> the key's counter index in each of depth rows of width counters, by
+    double hashing its SHA-1 (stable across clients and processes)
+    """
+    h1, h2 = struct.unpack('<II', hashlib.sha1(key_bytes(key)).digest()[:8])
+    h2 |= 1
+    return [i * width + (h1 + i * h2) % width for i in range(depth)]
+
+
 class TopTalkers(object):
-    def __init__(self, redis_host='localhost', redis_port=6379):
+    """
+    Space-Saving tables in Redis sorted sets, every update a Lua script.
+
+    With sketch_width set, each table gets a Count-Min sketch of sketch_depth
+    rows (4 * sketch_width * sketch_depth bytes) as an admission gate: once
+    the table is full, a new key only evicts the minimum if its estimated
+    frequency is above the minimum's count, and is otherwise dropped.  That
+    stops one-off keys from churning the table, at the cost of the strict
+    Space-Saving bound.  Weights go into the sketch rounded up to integers.
+
+    Each table also has an errors hash (see ERRORS_SUFFIX), written only on
+    evictions, from which top_n_bounds() reports how far each count may be
+    off.
+    """
+
+    def __init__(self, redis_host='localhost', redis_port=6379,
+                 sketch_width=0, sketch_depth=4):
         self.client = StrictRedis(host=redis_host, port=redis_port)
+        self.sketch_width = sketch_width
+        self.sketch_depth = sketch_depth
         self._is_full_inner = self.client.register_script(LUA_IS_FULL_INNER)
         self._clear = self.client.register_script(LUA_CLEAR)
         self._get = self.client.register_script(LUA_GET)
         self._add = self.client.register_script(LUA_ADD)
+        self._add_many = self.client.register_script(LUA_ADD_MANY)
+        self._add_gated = self.client.register_script(LUA_ADD_GATED)
+        self._add_many_gated = self.client.register_script(LUA_ADD_MANY_GATED)
         self._top_n_keys = self.client.register_script(LUA_TOP_N_KEYS)
         self._top_n_keys_counts = self.client.register_script(
             LUA_TOP_N_KEYS_COUNTS)
+        self._top_n_bounds = self.client.register_script(LUA_TOP_N_BOUNDS)
+        self._min_offset = self.client.register_script(LUA_MIN_OFFSET)
+        self.outcomes = None
+        self.latencies = None
+        self.cache = None
+        self._uncached_scripts = None
+        self._invalidator = None
+
+    def enable_cache(self, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL,
+                     invalidate=False):
+        """
+        Answer get(), contains() and the top-N queries from a client-side
+        cache.ReadCache of up to max_entries results, none older than ttl
+        seconds.  Adds are not seen by cached reads until then, though
+        clear() drops its table's results at once.
+
+        With invalidate=True a listener thread also drops a table's results
+        as soon as Redis reports a write to it.  That needs keyspace
+        notifications on the server (notify-keyspace-events Kzh) and pays
+        off for tables read far more often than they are written.
+
+        The cached scripts are set on this instance only; pipelined calls
+        (top_n_many()) are never cached.
+        """
+        if self.cache is not None:
+            return
+
+        self.cache = ReadCache(max_entries, ttl)
+        self._uncached_scripts = {}
+        for name, redis_tables in CACHED_SCRIPTS.items():
+            script = getattr(self, name, None)
+            if script is not None:
+                self._uncached_scripts[name] = script
+                setattr(self, name, cached_script(script, self.cache, name,
+                                                  redis_tables))
+        if invalidate:
+            self._invalidator = subscribe_invalidations(self.client,
+                                                        self.cache)
+
+    def disable_cache(self):
+        if self.cache is None:
+            return
+
+        if self._invalidator is not None:
+            self._invalidator.stop()
+            self._invalidator = None
+        for name, script in self._uncached_scripts.items():
+            setattr(self, name, script)
+        self._uncached_scripts = None
+        self.cache = None
+
+    def enable_stats(self):
+        """
+        Start timing calls and counting adds by outcome (see stats()).
+
+        The timed and counting methods are set on this instance only, so a
+        client that never enables stats pays nothing.
+        """
+        if self.latencies is not None:
+            return
+
+        self.latencies = instrument(self, STATS_METHODS)
+        self.outcomes = outcomes = [0, 0, 0, 0]
+        add = self.add
+        add_counts = self.add_counts
+        add_multi_table = self.add_multi_table
+
+        def counted_add(redis_table, redis_size, key, weight=1):
+            outcome = add(redis_table, redis_size, key, weight)
+            outcomes[outcome] += 1
+            return outcome
+
+        def counted_add_counts(redis_table, redis_size, key2weight,
+                               chunk_size=ADD_MANY_CHUNK, pipe=None):
+            r = add_counts(redis_table, redis_size, key2weight, chunk_size,
+                           pipe)
+            if r is not None:
+                for i in range(4):
+                    outcomes[i] += r[i]
+            return r
+
+        def counted_add_multi_table(rows, chunk_size=ADD_MANY_CHUNK):
+            r = add_multi_table(rows, chunk_size)
+            for i in range(4):
+                outcomes[i] += r[i]
+            return r
+
+        self.add = counted_add
+        self.add_counts = counted_add_counts
+        self.add_multi_table = counted_add_multi_table
+
+    def disable_stats(self):
+        uninstrument(self, STATS_METHODS)
+        self.outcomes = None
+        self.latencies = None
+
+    def stats(self, redis_table=None):
+        """
+        -> dict of hits, inserts, evictions, rejections and per-method latency
+        snapshots (see stats.LatencyHistogram) while stats are enabled, the
+        read cache's stats while it is enabled, plus tracked and min_count if
+        a table is given
+
+        Adds queued on a caller's pipe are timed but not counted.
+        """
+        r = {}
+        if self.latencies is not None:
+            r['hits'], r['inserts'], r['evictions'], r['rejections'] = \
+                self.outcomes
+            r['adds'] = sum(self.outcomes)
+            r['latency'] = snapshot_latencies(self.latencies)
+        if self.cache is not None:
+            r['cache'] = self.cache.stats()
+        if redis_table is not None:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.zcard(redis_table)
+            pipe.zrange(redis_table, 0, 0, withscores=True)
+            tracked, lowest_keys_counts = pipe.execute()
+            r['tracked'] = tracked
+            if lowest_keys_counts:
+                r['min_count'] = int(lowest_keys_counts[0][1])
+            else:
+                r['min_count'] = 0
+        return r
 
     def is_full_inner(self, redis_table, redis_size):
         r = self._is_full_inner(keys=[redis_table, redis_size])
@@ -96,6 +669,11 @@ class TopTalkers(object):
         table -> None
         """
         self._clear(keys=[redis_table])
+        self.client.delete(redis_table + ERRORS_SUFFIX)
+        if self.cache is not None:
+            self.cache.invalidate(redis_table)
+        if self.sketch_width:
+            self.client.delete(redis_table + SKETCH_SUFFIX)
 
     def is_full(self, redis_table, redis_size):
         """
@@ -121,11 +699,94 @@ class TopTalkers(object):
         count = self._get(keys=[redis_table, key])
         return count is not None
 
-    def add(self, redis_table, redis_size, key):
+    def add(self, redis_table, redis_size, key, weight=1):
         """
-        (table, size, key) -> None
+        (table, size, key, weight) -> OUTCOME_HIT, OUTCOME_INSERT,
+        OUTCOME_EVICTION or OUTCOME_REJECTION
         """
-        self._add(keys=[redis_table, redis_size, key])
+        errors = redis_table + ERRORS_SUFFIX
+        if self.sketch_width:
+            script_keys = [redis_table, redis_size, errors, key, weight,
+                           redis_table + SKETCH_SUFFIX]
+            script_keys.extend(
+                sketch_slots(key, self.sketch_width, self.sketch_depth))
+            return self._add_gated(keys=script_keys)
+
+        return self._add(keys=[redis_table, redis_size, errors, key, weight])
+
+    def add_many(self, redis_table, redis_size, keys,
+                 chunk_size=ADD_MANY_CHUNK):
+        """
+        (table, size, keys) -> None
+
+        Duplicates are collapsed into weights first, then applied as by
+        add_counts().
+        """
+        self.add_counts(redis_table, redis_size, Counter(keys), chunk_size)
+
+    def add_counts(self, redis_table, redis_size, key2weight,
+                   chunk_size=ADD_MANY_CHUNK, pipe=None):
+        """
+        (table, size, {key: weight}) -> [hits, inserts, evictions, rejections]
+
+        Keys are applied heaviest first.  Each chunk of keys runs atomically as
+        one LUA_ADD_MANY call, and all chunks go out in a single pipelined
+        round trip.  If pipe is given the calls are only queued on it, and the
+        result is None.
+        """
+        keys_weights = sorted(key2weight.items(), key=itemgetter(1),
+                              reverse=True)
+        if pipe is None:
+            batch = self.client.pipeline(transaction=False)
+        else:
+            batch = pipe
+        for i in range(0, len(keys_weights), chunk_size):
+            if self.sketch_width:
+                self._add_chunk_gated(redis_table, redis_size,
+                                      keys_weights[i:i + chunk_size], batch)
+                continue
+            script_keys = [redis_table, redis_size,
+                           redis_table + ERRORS_SUFFIX]
+            for key, weight in keys_weights[i:i + chunk_size]:
+                script_keys.append(key)
+                script_keys.append(weight)
+            self._add_many(keys=script_keys, client=batch)
+        if pipe is None:
+            return sum_outcomes(batch.execute())
+        return None
+
+    def _add_chunk_gated(self, redis_table, redis_size, keys_weights, pipe):
+        script_keys = [redis_table, redis_size, redis_table + ERRORS_SUFFIX,
+                       redis_table + SKETCH_SUFFIX, self.sketch_depth]
+        for key, weight in keys_weights:
+            script_keys.append(key)
+            script_keys.append(weight)
+            script_keys.extend(
+                sketch_slots(key, self.sketch_width, self.sketch_depth))
+        self._add_many_gated(keys=script_keys, client=pipe)
+
+    def add_multi_table(self, rows, chunk_size=ADD_MANY_CHUNK):
+        """
+        [(table, size, key) or (table, size, key, weight), ...] ->
+        [hits, inserts, evictions, rejections]
+
+        Rows are grouped by table and each table's keys applied as by
+        add_counts(), every table in one pipelined round trip.
+        """
+        table2counts = {}
+        for row in rows:
+            counts = table2counts.get(row[:2])
+            if counts is None:
+                counts = table2counts[row[:2]] = Counter()
+            if len(row) > 3:
+                counts[row[2]] += row[3]
+            else:
+                counts[row[2]] += 1
+
+        pipe = self.client.pipeline(transaction=False)
+        for (redis_table, redis_size), counts in table2counts.items():
+            self.add_counts(redis_table, redis_size, counts, chunk_size, pipe)
+        return sum_outcomes([r for r in pipe.execute() if isinstance(r, list)])
 
     def top_n_keys(self, redis_table, n):
         """
@@ -137,12 +798,297 @@ class TopTalkers(object):
         """
         (table, size, n) -> list of (key, count)
         """
-        rr = self._top_n_keys_counts(keys=[redis_table, redis_size, n])
-        pairs = []
-        for i in range(len(rr) / 2):
-            pair = (rr[i * 2], int(rr[i * 2 + 1]))
-            pairs.append(pair)
-        return pairs
+        rr = self._top_n_keys_counts_call(redis_table, redis_size, n)
+        return pairs_from_flat(rr)
+
+    def _top_n_keys_counts_call(self, redis_table, redis_size, n,
+                                client=None):
+        """
+        Run (or, given a pipeline, queue) the script behind
+        top_n_keys_counts().
+        """
+        return self._top_n_keys_counts(keys=[redis_table, redis_size, n],
+                                       client=client)
+
+    def top_n_bounds(self, redis_table, redis_size, n):
+        """
+        (table, size, n) -> list of (key, count, error, guaranteed)
+
+        The key's true count is between count - error and count, and a
+        guaranteed key is in the true top n whatever the stream was.  Counts
+        here are the raw upper bounds, not top_n_keys_counts()' offset ones.
+        With the admission sketch counts are no longer upper bounds, so
+        nothing is guaranteed.
+        """
+        errors = redis_table + ERRORS_SUFFIX
+        rr = self._top_n_bounds(keys=[redis_table, redis_size, errors, n])
+        bounds = bounds_from_flat(rr)
+        if self.sketch_width:
+            bounds = [(key, count, error, False)
+                      for key, count, error, guaranteed in bounds]
+        return bounds
+
+    def iter_keys_counts(self, redis_table, redis_size,
+                         chunk_size=EXPORT_CHUNK, ordered=True):
+        """
+        (table, size) -> generator of (key, count) over the whole table, counts
+        offset as by top_n_keys_counts()
+
+        Rows are read chunk_size at a time, largest first, so no command blocks
+        Redis for more than one page and the client holds one page at a time.
+        The min offset is read once, up front.  Ranks can shift between pages
+        under concurrent adds, repeating or skipping a row; with ordered=False
+        the table is walked with ZSCAN instead, unordered, but every key
+        present for the whole export is yielded at least once.
+        """
+        the_min = self._min_offset(keys=[redis_table, redis_size])
+        for page in self._export_pages(redis_table, chunk_size, ordered):
+            for key, count in page:
+                yield key, int(count) - the_min
+
+    def _export_pages(self, redis_table, chunk_size, ordered):
+        """
+        -> generator of lists of (key, raw count), by rank or by ZSCAN
+        """
+        if ordered:
+            start = 0
+            while True:
+                stop = start + chunk_size - 1
+                page = self.client.zrevrange(redis_table, start, stop,
+                                             withscores=True)
+                if page:
+                    yield page
+                if len(page) < chunk_size:
+                    return
+                start += chunk_size
+
+        cursor = 0
+        while True:
+            cursor, page = self.client.zscan(redis_table, cursor,
+                                             count=chunk_size)
+            if page:
+                yield page
+            if not int(cursor):
+                return
+
+    def top_n_many(self, queries):
+        """
+        [(table, size, n), ...] -> list of top_n_keys_counts() results, all
+        queries in one pipelined round trip
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for query in queries:
+            self._top_n_keys_counts_call(*query, client=pipe)
+        return [pairs_from_flat(rr) for rr in pipe.execute()]
+
+
+class WindowedTopTalkers(TopTalkers):
+    """
+    TopTalkers over a sliding window of num_epochs epochs of epoch_seconds.
+
+    Each epoch of a table is its own sorted set, "<table>:<epoch>", which
+    expires once it has left the window.  Adds go to the current epoch and
+    queries merge the epochs in the window server-side, so stale keys age out
+    without a clear() and refill.  iter_keys_counts() exports one epoch table
+    (see epoch_tables()).
+
+    Merged queries, get() and contains() included, read every row of the
+    window's epoch tables in one blocking script (see LUA_MERGE): about
+    num_epochs * size rows each.  Dashboards polling a large window should
+    enable_cache() or query fewer epochs.
+    """
+
+    def __init__(self, redis_host='localhost', redis_port=6379,
+                 epoch_seconds=60, num_epochs=5, clock=time.time):
+        TopTalkers.__init__(self, redis_host, redis_port)
+        self.epoch_seconds = epoch_seconds
+        self.num_epochs = num_epochs
+        self.clock = clock
+        self.ttl = int((num_epochs + 1) * epoch_seconds)
+        self._get_merged = self.client.register_script(LUA_GET_MERGED)
+        self._top_n_keys_counts_merged = self.client.register_script(
+            LUA_TOP_N_KEYS_COUNTS_MERGED)
+        self._top_n_bounds_merged = self.client.register_script(
+            LUA_TOP_N_BOUNDS_MERGED)
+
+    def epoch_tables(self, redis_table, num_epochs=None):
+        """
+        (table, num_epochs) -> list of epoch tables, newest first
+        """
+        if num_epochs is None:
+            num_epochs = self.num_epochs
+        epoch = int(self.clock() // self.epoch_seconds)
+        return ['%s:%d' % (redis_table, epoch - i) for i in range(num_epochs)]
+
+    def clear(self, redis_table):
+        epoch_tables = self.epoch_tables(redis_table)
+        self.client.delete(*epoch_tables + [
+            epoch_table + ERRORS_SUFFIX for epoch_table in epoch_tables])
+        if self.cache is not None:
+            self.cache.invalidate(redis_table)
+
+    def is_full(self, redis_table, redis_size):
+        """
+        Whether the current epoch is full.
+        """
+        return TopTalkers.is_full(
+            self, self.epoch_tables(redis_table, 1)[0], redis_size)
+
+    def get(self, redis_table, key, redis_size=0):
+        """
+        (table, key, size) -> the key's count in the merged window, or None
+        if the merge drops it, as local.WindowedTopTalkerTracker.get()
+
+        The size decides the epochs' floors that a missing key is charged;
+        pass the one the table is added to with, or leave it 0 to merge as
+        top_n_keys() does, as if no epoch were full.
+        """
+        return self._get_merged(
+            keys=[redis_size, key] + self.epoch_tables(redis_table))
+
+    def contains(self, redis_table, key, redis_size=0):
+        return self.get(redis_table, key, redis_size) is not None
+
+    def add(self, redis_table, redis_size, key, weight=1):
+        epoch_table = self.epoch_tables(redis_table, 1)[0]
+        errors = epoch_table + ERRORS_SUFFIX
+        pipe = self.client.pipeline(transaction=False)
+        self._add(keys=[epoch_table, redis_size, errors, key, weight],
+                  client=pipe)
+        pipe.expire(epoch_table, self.ttl)
+        pipe.expire(errors, self.ttl)
+        return pipe.execute()[0]
+
+    def add_counts(self, redis_table, redis_size, key2weight,
+                   chunk_size=ADD_MANY_CHUNK, pipe=None):
+        epoch_table = self.epoch_tables(redis_table, 1)[0]
+        if pipe is None:
+            batch = self.client.pipeline(transaction=False)
+        else:
+            batch = pipe
+        TopTalkers.add_counts(self, epoch_table, redis_size, key2weight,
+                              chunk_size, batch)
+        batch.expire(epoch_table, self.ttl)
+        batch.expire(epoch_table + ERRORS_SUFFIX, self.ttl)
+        if pipe is None:
+            return sum_outcomes(batch.execute()[:-2])
+        return None
+
+    def stats(self, redis_table=None):
+        """
+        As TopTalkers.stats(), with tracked and min_count for the current
+        epoch of the table.
+        """
+        if redis_table is not None:
+            redis_table = self.epoch_tables(redis_table, 1)[0]
+        return TopTalkers.stats(self, redis_table)
+
+    def top_n_keys(self, redis_table, n, num_epochs=None):
+        return [key for key, count in
+                self.top_n_keys_counts(redis_table, 0, n, num_epochs)]
+
+    def top_n_keys_counts(self, redis_table, redis_size, n, num_epochs=None):
+        """
+        (table, size, n, num_epochs) -> list of (key, count) over the last
+        num_epochs epochs (default: the whole window)
+        """
+        rr = self._top_n_keys_counts_call(redis_table, redis_size, n,
+                                          num_epochs=num_epochs)
+        return pairs_from_flat(rr)
+
+    def _top_n_keys_counts_call(self, redis_table, redis_size, n,
+                                client=None, num_epochs=None):
+        return self._top_n_keys_counts_merged(
+            keys=[redis_size, n] + self.epoch_tables(redis_table, num_epochs),
+            client=client)
+
+    def top_n_bounds(self, redis_table, redis_size, n, num_epochs=None):
+        """
+        (table, size, n, num_epochs) -> list of (key, count, error,
+        guaranteed) over the last num_epochs epochs (default: the whole
+        window)
+        """
+        script_keys = [redis_size, n]
+        for epoch_table in self.epoch_tables(redis_table, num_epochs):
+            script_keys.append(epoch_table)
+            script_keys.append(epoch_table + ERRORS_SUFFIX)
+        return bounds_from_flat(self._top_n_bounds_merged(keys=script_keys))
+
+
+def check_windowed_agrees(redis_table, trials=20, seed=0):
+    """
+    WindowedTopTalkers must report what local.WindowedTopTalkerTracker
+    reports for the same adds.  Windows whose merged counts tie are skipped,
+    as the backends break ties differently.
+    """
+    from local import WindowedTopTalkerTracker, merge_entries
+
+    rng = random.Random(seed)
+    for trial in range(trials):
+        now = [0]
+        size = rng.randint(1, 6)
+        w = WindowedTopTalkers(epoch_seconds=60, num_epochs=3,
+                               clock=lambda: now[0])
+        t = WindowedTopTalkerTracker(size, epoch_seconds=60, num_epochs=3,
+                                     clock=lambda: now[0])
+        w.clear(redis_table)
+        for epoch in range(rng.randint(1, 4)):
+            now[0] = 60 * epoch
+            for i in range(rng.randint(0, 3 * size)):
+                key = 'k%d' % rng.randint(0, 2 * size)
+                weight = rng.randint(1, 1 << 20)
+                w.add(redis_table, size, key, weight)
+                t.add(key, None, weight)
+
+        counts = [entry[1] for entry in merge_entries(
+            [tracker for e, tracker in filter(None, t.ring)
+             if e > t.current_epoch() - t.num_epochs], len(t.ring) * size)]
+        if len(set(counts)) < len(counts):
+            w.clear(redis_table)
+            continue
+        n = rng.randint(1, size + 2)
+        assert w.top_n_keys_counts(redis_table, size, n) == \
+            [(a.key, a.count) for a in t.top_n(n)]
+        assert w.top_n_bounds(redis_table, size, n) == t.top_n_bounds(n)
+        for i in range(2 * size + 1):
+            key = 'k%d' % i
+            if t.contains(key):
+                assert w.get(redis_table, key, size) == t.get(key).count
+            else:
+                assert w.get(redis_table, key, size) is None
+        w.clear(redis_table)
+
+
+def check_cache_invalidation(redis_table, redis_size, redis_host='localhost',
+                             redis_port=6379):
+    """
+    Keyspace notifications must cut a cached read's staleness short of the
+    ttl.  Turns notifications on for the test and restores them after.
+    """
+    t = TopTalkers(redis_host, redis_port)
+    other = TopTalkers(redis_host, redis_port)
+    try:
+        config = t.client.config_get('notify-keyspace-events')
+    except ResponseError:
+        print('check_cache_invalidation: CONFIG GET unsupported, skipped')
+        return
+
+    t.client.config_set('notify-keyspace-events', 'Kzh')
+    t.clear(redis_table)
+    t.enable_cache(ttl=60, invalidate=True)
+    other.add(redis_table, redis_size, 'cat')
+    assert t.get(redis_table, 'cat') == 1
+    other.add(redis_table, redis_size, 'cat')
+    deadline = time.time() + 5
+    while t.get(redis_table, 'cat') != 2:
+        assert time.time() < deadline
+        time.sleep(0.01)
+    # Only the table is subscribed, not the keys read from it.
+    assert t._invalidator.subscribed == set([redis_table])
+    t.disable_cache()
+    t.client.config_set('notify-keyspace-events',
+                        config['notify-keyspace-events'])
+    t.clear(redis_table)
 
 
 def main():
@@ -214,6 +1160,145 @@ def main():
 
     t.clear(redis_table)
 
+    t.add(redis_table, redis_size, 'cat', 5)
+    assert t.get(redis_table, 'cat') == 5
+    t.add(redis_table, redis_size, 'dog', 2)
+    t.add(redis_table, redis_size, 'cat', 3)
+    assert t.get(redis_table, 'cat') == 8
+    t.add(redis_table, redis_size, 'llama')
+    t.add(redis_table, redis_size, 'goose', 4)
+    assert t.is_full(redis_table, redis_size)
+    t.add(redis_table, redis_size, 'mouse', 10)
+    assert not t.contains(redis_table, 'llama')
+    assert t.get(redis_table, 'mouse') == 11
+    assert t.top_n_keys(redis_table, 3) == ['mouse', 'cat', 'goose']
+    assert t.top_n_keys_counts(redis_table, redis_size, 3) == [('mouse', 10), ('cat', 7), ('goose', 3)]
+    t.add(redis_table, redis_size, 'cow')
+    assert t.top_n_bounds(redis_table, redis_size, 4) == [
+        ('mouse', 11, 1, True), ('cat', 8, 0, True), ('goose', 4, 0, True),
+        ('cow', 3, 2, False)]
+    assert t.client.hlen(redis_table + ERRORS_SUFFIX) == 2
+
+    t.clear(redis_table)
+
+    t.add_many(redis_table, redis_size,
+               ['cat', 'dog', 'cat', 'llama', 'cat', 'goose', 'dog'])
+    assert t.is_full(redis_table, redis_size)
+    assert t.top_n_keys_counts(redis_table, redis_size, 2) == [('cat', 3), ('dog', 2)]
+    t.add_many(redis_table, redis_size, ['mouse'] * 5 + ['cat'], chunk_size=1)
+    assert t.get(redis_table, 'mouse') == 6
+    assert t.get(redis_table, 'cat') == 4
+    assert t.top_n_keys(redis_table, 2) == ['mouse', 'cat']
+
+    t.clear(redis_table)
+
+    t.add_many(redis_table, 10, ['k%d' % (i % 25) for i in range(100)])
+    everything = t.top_n_keys_counts(redis_table, 10, 10)
+    assert list(t.iter_keys_counts(redis_table, 10, chunk_size=3)) == \
+        everything
+    assert sorted(t.iter_keys_counts(redis_table, 10, chunk_size=3,
+                                     ordered=False)) == sorted(everything)
+
+    t.clear(redis_table)
+
+    t.enable_stats()
+    for key in ['cat', 'dog', 'cat', 'llama', 'goose', 'mouse']:
+        t.add(redis_table, redis_size, key)
+    t.add_many(redis_table, redis_size, ['cat', 'cow', 'cow'])
+    stats = t.stats(redis_table)
+    assert (stats['adds'], stats['hits'], stats['inserts'],
+            stats['evictions']) == (8, 2, 4, 2)
+    assert stats['latency']['add']['count'] == 6
+    assert stats['latency']['add_counts']['count'] == 1
+    assert (stats['tracked'], stats['min_count']) == (4, 1)
+    t.disable_stats()
+    assert t.stats() == {}
+
+    t.clear(redis_table)
+
+    g = TopTalkers(sketch_width=64)
+    g.clear(redis_table)
+    g.enable_stats()
+    for key in ['cat', 'cat', 'dog', 'llama', 'goose']:
+        g.add(redis_table, redis_size, key)
+    assert g.add(redis_table, redis_size, 'mouse') == OUTCOME_REJECTION
+    assert not g.contains(redis_table, 'mouse')
+    assert g.add(redis_table, redis_size, 'mouse') == OUTCOME_EVICTION
+    assert g.get(redis_table, 'mouse') == 2
+    g.add_many(redis_table, redis_size, ['cow', 'cat'])
+    assert not g.contains(redis_table, 'cow')
+    assert g.get(redis_table, 'cat') == 3
+    stats = g.stats()
+    assert (stats['hits'], stats['inserts'], stats['evictions'],
+            stats['rejections']) == (2, 4, 1, 2)
+    g.clear(redis_table)
+    assert not g.client.exists(redis_table + SKETCH_SUFFIX)
+
+    t.enable_stats()
+    rows = [('tenant:%d' % (i % 3), 8, 'k%d' % (i % 5)) for i in range(30)]
+    rows.append(('tenant:0', 8, 'k0', 10))
+    assert t.add_multi_table(rows) == [0, 15, 0, 0]
+    assert t.stats()['inserts'] == 15
+    t.disable_stats()
+    assert t.top_n_many([('tenant:0', 8, 1), ('tenant:1', 8, 2),
+                         ('tenant:9', 8, 1)]) == [[('k0', 12)], [('k4', 2), ('k3', 2)], []]
+    for i in range(3):
+        t.clear('tenant:%d' % i)
+
+    t.clear(redis_table)
+    t.add(redis_table, redis_size, 'cat')
+    other = TopTalkers()
+    t.enable_cache(ttl=60)
+    assert t.get(redis_table, 'cat') == 1
+    other.add(redis_table, redis_size, 'cat')
+    assert t.get(redis_table, 'cat') == 1
+    assert t.contains(redis_table, 'cat')
+    assert t.top_n_keys_counts(redis_table, redis_size, 1) == [('cat', 2)]
+    other.add(redis_table, redis_size, 'cat')
+    assert t.top_n_keys_counts(redis_table, redis_size, 1) == [('cat', 2)]
+    assert t.top_n_many([(redis_table, redis_size, 1)]) == [[('cat', 3)]]
+    stats = t.stats()['cache']
+    assert (stats['hits'], stats['misses']) == (3, 2)
+    t.clear(redis_table)
+    assert t.get(redis_table, 'cat') is None
+    t.disable_cache()
+    assert 'cache' not in t.stats()
+    check_cache_invalidation(redis_table, redis_size)
+
+    now = [0]
+    w = WindowedTopTalkers(epoch_seconds=60, num_epochs=2,
+                           clock=lambda: now[0])
+    w.clear(redis_table)
+    w.add(redis_table, redis_size, 'cat', 3)
+    w.add(redis_table, redis_size, 'dog')
+    now[0] = 60
+    w.add_many(redis_table, redis_size, ['dog', 'dog', 'dog', 'llama'])
+    assert w.get(redis_table, 'dog', redis_size) == 4
+    assert w.get(redis_table, 'dog') == 4
+    assert w.top_n_keys(redis_table, 3) == ['dog', 'cat', 'llama']
+    assert w.top_n_keys_counts(redis_table, redis_size, 3) == [('dog', 4), ('cat', 3), ('llama', 1)]
+    assert w.top_n_keys_counts(redis_table, redis_size, 3, num_epochs=1) == [('dog', 3), ('llama', 1)]
+    now[0] = 120
+    assert not w.contains(redis_table, 'cat', redis_size)
+    assert w.top_n_keys_counts(redis_table, redis_size, 3) == [('dog', 3), ('llama', 1)]
+    now[0] = 60
+    w.add(redis_table, 2, 'cow', 2)
+    assert w.top_n_bounds(redis_table, 2, 2) == [
+        ('cat', 6, 3, False), ('dog', 4, 0, True)]
+    # cow ties dog at 4 and, as in top_n_keys_counts(), loses the tie.
+    assert [w.get(redis_table, key, 2) for key in ['cat', 'dog', 'cow']] == \
+        [6, 4, None]
+    assert w.top_n_keys_counts(redis_table, 2, 5) == [('cat', 3), ('dog', 1)]
+    w.clear(redis_table)
+
+    w.enable_cache(ttl=60)
+    w.add(redis_table, redis_size, 'cat', 3)
+    assert w.top_n_keys_counts(redis_table, redis_size, 1) == [('cat', 3)]
+    w.clear(redis_table)
+    assert w.top_n_keys_counts(redis_table, redis_size, 1) == []
+    w.disable_cache()
+    check_windowed_agrees(redis_table)
+
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,163 @@
+import asyncio
+
+from redis.asyncio import Redis
+
+from redis_lua import (
+    ERRORS_SUFFIX, LUA_ADD, LUA_CLEAR, LUA_GET, LUA_IS_FULL_INNER,
+    LUA_TOP_N_KEYS, LUA_TOP_N_KEYS_COUNTS, pairs_from_flat)
+
+
+# Most adds sent in one pipelined round trip.
+MAX_BATCH = 1000
+
+
+class AsyncTopTalkers(object):
+    """
+    asyncio twin of redis_lua.TopTalkers (Python 3 only), running the same Lua
+    scripts over a redis.asyncio connection pool.
+
+    add() calls are pipelined automatically: each one queues its script call
+    and waits on a future, and a single flusher task sends everything queued
+    by the time it runs as one round trip, so concurrent callers share RTTs.
+    """
+
+    def __init__(self, redis_host='localhost', redis_port=6379,
+                 max_batch=MAX_BATCH, decode_responses=True):
+        self.client = Redis(host=redis_host, port=redis_port,
+                            decode_responses=decode_responses)
+        self.max_batch = max_batch
+        self._is_full_inner = self.client.register_script(LUA_IS_FULL_INNER)
+        self._clear = self.client.register_script(LUA_CLEAR)
+        self._get = self.client.register_script(LUA_GET)
+        self._add = self.client.register_script(LUA_ADD)
+        self._top_n_keys = self.client.register_script(LUA_TOP_N_KEYS)
+        self._top_n_keys_counts = self.client.register_script(
+            LUA_TOP_N_KEYS_COUNTS)
+        self.pending = []
+        self.flusher = None
+
+    async def close(self):
+        await self.client.aclose()
+
+    async def clear(self, redis_table):
+        """
+        table -> None
+        """
+        await self._clear(keys=[redis_table])
+        await self.client.delete(redis_table + ERRORS_SUFFIX)
+
+    async def is_full(self, redis_table, redis_size):
+        """
+        (table, size) -> bool
+        """
+        r = await self._is_full_inner(keys=[redis_table, redis_size])
+        return bool(r)
+
+    async def get(self, redis_table, key):
+        """
+        (table, key) -> count or None
+        """
+        count = await self._get(keys=[redis_table, key])
+
+        if count is None:
+            return count
+
+        return int(count)
+
+    async def contains(self, redis_table, key):
+        """
+        (table, key) -> bool
+        """
+        count = await self._get(keys=[redis_table, key])
+        return count is not None
+
+    async def add(self, redis_table, redis_size, key, weight=1):
+        """
+        (table, size, key, weight) -> None
+        """
+        future = asyncio.get_running_loop().create_future()
+        script_keys = [redis_table, redis_size, redis_table + ERRORS_SUFFIX,
+                       key, weight]
+        self.pending.append((script_keys, future))
+        if self.flusher is None:
+            self.flusher = asyncio.ensure_future(self.flush_pending())
+        await future
+
+    async def flush_pending(self):
+        # Yield once so every caller that is ready this tick gets queued.
+        await asyncio.sleep(0)
+        try:
+            while self.pending:
+                batch = self.pending[:self.max_batch]
+                del self.pending[:self.max_batch]
+                try:
+                    pipe = self.client.pipeline(transaction=False)
+                    for script_keys, future in batch:
+                        await self._add(keys=script_keys, client=pipe)
+                    results = await pipe.execute(raise_on_error=False)
+                except Exception as e:
+                    results = [e] * len(batch)
+                for (script_keys, future), result in zip(batch, results):
+                    if future.done():
+                        continue
+                    if isinstance(result, Exception):
+                        future.set_exception(result)
+                    else:
+                        future.set_result(None)
+        finally:
+            self.flusher = None
+
+    async def top_n_keys(self, redis_table, n):
+        """
+        (table, n) -> list of keys
+        """
+        return await self._top_n_keys(keys=[redis_table, n])
+
+    async def top_n_keys_counts(self, redis_table, redis_size, n):
+        """
+        (table, size, n) -> list of (key, count)
+        """
+        rr = await self._top_n_keys_counts(keys=[redis_table, redis_size, n])
+        return pairs_from_flat(rr)
+
+
+async def check():
+    redis_table = 'top_talkers'
+    redis_size = 4
+
+    t = AsyncTopTalkers()
+
+    await t.clear(redis_table)
+
+    assert not await t.is_full(redis_table, redis_size)
+    assert not await t.contains(redis_table, 'cat')
+    assert await t.get(redis_table, 'cat') is None
+    assert await t.top_n_keys(redis_table, 3) == []
+    assert await t.top_n_keys_counts(redis_table, redis_size, 3) == []
+
+    # 100 concurrent adds share one round trip.
+    await asyncio.gather(*[t.add(redis_table, redis_size, 'cat')
+                           for i in range(100)])
+    assert await t.get(redis_table, 'cat') == 100
+
+    await t.add(redis_table, redis_size, 'dog', 5)
+    await asyncio.gather(t.add(redis_table, redis_size, 'llama'),
+                         t.add(redis_table, redis_size, 'goose', 2))
+    assert await t.is_full(redis_table, redis_size)
+    assert await t.top_n_keys(redis_table, 3) == ['cat', 'dog', 'goose']
+    assert await t.top_n_keys_counts(redis_table, redis_size, 3) == [('cat', 100), ('dog', 5), ('goose', 2)]
+
+    await t.add(redis_table, redis_size, 'mouse', 10)
+    assert not await t.contains(redis_table, 'llama')
+    assert await t.top_n_keys_counts(redis_table, redis_size, 2) == [('cat', 99), ('mouse', 10)]
+
+    await t.clear(redis_table)
+    await t.close()
+
+
+def main():
+    asyncio.run(check())
+
+
+if __name__ == '__main__':
+    main()
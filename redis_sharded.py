@@ -0,0 +1,162 @@
+import heapq
+from multiprocessing.pool import ThreadPool
+import zlib
+
+from redis_lua import TopTalkers, key_bytes
+
+
+def count_then_key(key_count):
+    key, count = key_count
+    return count, key
+
+
+class ShardedTopTalkers(object):
+    """
+    One logical table hash-partitioned across several Redis instances.
+
+    Each key lives on exactly one node (by crc32), in a Space-Saving sub-table
+    of size / num_nodes running the usual redis_lua scripts.  Every node's
+    top_n_keys_counts is already corrected by that node's own min offset, so
+    the global answer is the n largest of the per-node answers, fetched in
+    parallel.  top_n_keys() ranks the same corrected counts.  close() shuts
+    down the thread pool.
+    """
+
+    def __init__(self, nodes=(('localhost', 6379),)):
+        self.shards = [TopTalkers(host, port) for host, port in nodes]
+        self.pool = ThreadPool(len(self.shards))
+
+    def close(self):
+        """
+        Stop the fan-out threads.
+        """
+        self.pool.close()
+        self.pool.join()
+
+    def shard_size(self, redis_size):
+        return (redis_size + len(self.shards) - 1) // len(self.shards)
+
+    def shard_index(self, key):
+        return (zlib.crc32(key_bytes(key)) & 0xffffffff) % len(self.shards)
+
+    def fan_out(self, f):
+        """
+        Call f(shard) on every shard in parallel -> list of results
+        """
+        return self.pool.map(f, self.shards)
+
+    def clear(self, redis_table):
+        """
+        table -> None
+        """
+        self.fan_out(lambda shard: shard.clear(redis_table))
+
+    def is_full(self, redis_table, redis_size):
+        """
+        (table, size) -> bool, whether every node's sub-table is full
+        """
+        shard_size = self.shard_size(redis_size)
+        return all(self.fan_out(
+            lambda shard: shard.is_full(redis_table, shard_size)))
+
+    def get(self, redis_table, key):
+        """
+        (table, key) -> count or None
+        """
+        return self.shards[self.shard_index(key)].get(redis_table, key)
+
+    def contains(self, redis_table, key):
+        """
+        (table, key) -> bool
+        """
+        return self.shards[self.shard_index(key)].contains(redis_table, key)
+
+    def add(self, redis_table, redis_size, key, weight=1):
+        """
+        (table, size, key, weight) -> None
+        """
+        shard = self.shards[self.shard_index(key)]
+        shard.add(redis_table, self.shard_size(redis_size), key, weight)
+
+    def add_many(self, redis_table, redis_size, keys):
+        """
+        (table, size, keys) -> None
+
+        The batch is split by node and each node's part goes out as one
+        TopTalkers.add_many() call, all nodes in parallel.
+        """
+        shard_keys = [[] for shard in self.shards]
+        for key in keys:
+            shard_keys[self.shard_index(key)].append(key)
+        shard_size = self.shard_size(redis_size)
+
+        def add_many(i):
+            if shard_keys[i]:
+                self.shards[i].add_many(redis_table, shard_size, shard_keys[i])
+
+        self.pool.map(add_many, range(len(self.shards)))
+
+    def top_n_keys(self, redis_table, redis_size, n):
+        """
+        (table, size, n) -> list of keys, in top_n_keys_counts() order
+
+        Nodes' raw counts carry different min offsets, so unlike
+        TopTalkers.top_n_keys() this needs the size to correct them.
+        """
+        return [key for key, count in
+                self.top_n_keys_counts(redis_table, redis_size, n)]
+
+    def top_n_keys_counts(self, redis_table, redis_size, n):
+        """
+        (table, size, n) -> list of (key, count)
+        """
+        shard_size = self.shard_size(redis_size)
+        keys_counts = []
+        for pairs in self.fan_out(lambda shard: shard.top_n_keys_counts(
+                redis_table, shard_size, n)):
+            keys_counts.extend(pairs)
+        return heapq.nlargest(n, keys_counts, key=count_then_key)
+
+
+def main():
+    """
+    Needs redis-server on ports 6379, 6380 and 6381.
+    """
+    redis_table = 'top_talkers'
+    redis_size = 30
+
+    t = ShardedTopTalkers([('localhost', 6379), ('localhost', 6380),
+                           ('localhost', 6381)])
+
+    t.clear(redis_table)
+
+    assert not t.is_full(redis_table, redis_size)
+    assert t.top_n_keys_counts(redis_table, redis_size, 3) == []
+
+    for i, key in enumerate(['cat', 'dog', 'llama', 'goose', 'mouse']):
+        t.add(redis_table, redis_size, key, 10 - i)
+    assert t.get(redis_table, 'goose') == 7
+    assert t.contains(redis_table, 'llama')
+    assert not t.contains(redis_table, 'cow')
+    assert t.top_n_keys_counts(redis_table, redis_size, 3) == [('cat', 10), ('dog', 9), ('llama', 8)]
+
+    t.add_many(redis_table, redis_size, ['mouse'] * 5 + ['cow'])
+    assert t.get(redis_table, 'mouse') == 11
+    assert t.top_n_keys(redis_table, redis_size, 2) == ['mouse', 'cat']
+    assert t.top_n_keys_counts(redis_table, redis_size, 7)[-1] == ('cow', 1)
+
+    # Fill every node's sub-table (10 each) so evictions kick in.
+    t.add_many(redis_table, redis_size, ['k%d' % i for i in range(100)])
+    assert t.is_full(redis_table, redis_size)
+    assert t.top_n_keys(redis_table, redis_size, 1) == ['mouse']
+    everything = t.top_n_keys_counts(redis_table, redis_size, 100)
+    assert len(everything) == 30
+    assert t.top_n_keys(redis_table, redis_size, 30) == \
+        [key for key, count in everything]
+
+    t.clear(redis_table)
+    t.close()
+
+
+if __name__ == '__main__':
+    main()
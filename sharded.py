@@ -0,0 +1,201 @@
+from __future__ import print_function
+
+import heapq
+from operator import attrgetter
+import random
+import sys
+import threading
+import time
+
+from local import ENGINE_HEAP, ENGINE_STREAM_SUMMARY, TopTalkerTracker
+
+
+class ShardedTopTalkerTracker(object):
+    """
+    Thread-safe top talker tracker.
+
+    Keys are routed by hash to one of num_shards local trackers, each of
+    size / num_shards behind its own lock, so threads adding different keys
+    rarely contend.  Since a key only ever lives in one shard, each shard's
+    top_n (already corrected by that shard's min offset) is exact for its keys
+    and the global top_n is the n largest across shards.
+    """
+
+    def __init__(self, size, num_shards=16, engine=ENGINE_HEAP):
+        self.size = size
+        self.num_shards = num_shards
+        shard_size = (size + num_shards - 1) // num_shards
+        self.shards = [TopTalkerTracker(shard_size, engine)
+                       for i in range(num_shards)]
+        self.locks = [threading.Lock() for i in range(num_shards)]
+
+    def shard_index(self, key):
+        return hash(key) % self.num_shards
+
+    def is_full(self):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                if not shard.is_full():
+                    return False
+        return True
+
+    def get(self, key):
+        i = self.shard_index(key)
+        with self.locks[i]:
+            return self.shards[i].get(key)
+
+    def contains(self, key):
+        i = self.shard_index(key)
+        with self.locks[i]:
+            return self.shards[i].contains(key)
+
+    def add(self, key, data, weight=1):
+        i = self.shard_index(key)
+        with self.locks[i]:
+            self.shards[i].add(key, data, weight)
+
+    def add_many(self, keys, data=None):
+        """
+        Split the batch by shard, then take each shard's lock once.
+        """
+        shard_keys = [[] for i in range(self.num_shards)]
+        shard_data = [[] for i in range(self.num_shards)]
+        if data is None:
+            data = [None] * len(keys)
+        shard_index = self.shard_index
+        for key, datum in zip(keys, data):
+            i = shard_index(key)
+            shard_keys[i].append(key)
+            shard_data[i].append(datum)
+
+        for i in range(self.num_shards):
+            if not shard_keys[i]:
+                continue
+            with self.locks[i]:
+                self.shards[i].add_many(shard_keys[i], shard_data[i])
+
+    def enable_stats(self):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.enable_stats()
+
+    def disable_stats(self):
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard.disable_stats()
+
+    def stats(self):
+        """
+        The shards' stats() summed, with min_count the smallest shard's.
+        """
+        shard_stats = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                shard_stats.append(shard.stats())
+        r = {
+            'size': self.size,
+            'tracked': sum(s['tracked'] for s in shard_stats),
+            'is_full': all(s['is_full'] for s in shard_stats),
+            'min_count': min(s['min_count'] for s in shard_stats),
+        }
+        if 'adds' in shard_stats[0]:
+            for name in ('adds', 'hits', 'inserts', 'evictions', 'rejections'):
+                r[name] = sum(s[name] for s in shard_stats)
+            adds = r['adds']
+            r['hit_rate'] = float(r['hits']) / adds if adds else 0.0
+            r['eviction_rate'] = float(r['evictions']) / adds if adds else 0.0
+        return r
+
+    def top_n(self, n):
+        members = []
+        for shard, lock in zip(self.shards, self.locks):
+            with lock:
+                members.extend(shard.top_n(n))
+        return heapq.nlargest(n, members, key=attrgetter('count'))
+
+
+class LockedTopTalkerTracker(object):
+    """
+    The baseline: one tracker behind one lock.
+    """
+
+    def __init__(self, size, engine=ENGINE_HEAP):
+        self.tracker = TopTalkerTracker(size, engine)
+        self.lock = threading.Lock()
+
+    def add(self, key, data, weight=1):
+        with self.lock:
+            self.tracker.add(key, data, weight)
+
+
+def run_threads(tracker, streams):
+    def work(stream):
+        add = tracker.add
+        for key in stream:
+            add(key, None)
+
+    threads = [threading.Thread(target=work, args=(stream,))
+               for stream in streams]
+    t0 = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return time.time() - t0
+
+
+def bench(size=16384, adds_per_thread=200000, thread_counts=(1, 2, 4, 8),
+          num_shards=16, seed=0):
+    """
+    Print add() throughput by thread count, single lock vs sharded.
+
+    On a GIL build the shards only remove lock contention; on a free-threaded
+    build (python3.13t and later) they let the threads run in parallel.
+    """
+    is_gil_enabled = getattr(sys, '_is_gil_enabled', lambda: True)()
+    print('python %s, GIL %s' % (sys.version.split()[0],
+                                 'enabled' if is_gil_enabled else 'disabled'))
+    print('%-16s %8s %14s %14s' % ('engine', 'threads', 'locked ops/s',
+                                    'sharded ops/s'))
+    rng = random.Random(seed)
+    for num_threads in thread_counts:
+        streams = [[int(rng.paretovariate(1.1))
+                    for j in range(adds_per_thread)]
+                   for i in range(num_threads)]
+        num_adds = num_threads * adds_per_thread
+        for engine in (ENGINE_HEAP, ENGINE_STREAM_SUMMARY):
+            locked = LockedTopTalkerTracker(size, engine)
+            sharded = ShardedTopTalkerTracker(size, num_shards, engine)
+            locked_rate = num_adds / run_threads(locked, streams)
+            sharded_rate = num_adds / run_threads(sharded, streams)
+            print('%-16s %8d %14d %14d' % (engine, num_threads, locked_rate,
+                                           sharded_rate))
+
+
+def main():
+    t = ShardedTopTalkerTracker(64, num_shards=4)
+    for i, key in enumerate(['cat', 'cat', 'dog', 'cat', 'llama', 'dog']):
+        t.add(key, i)
+    assert t.get('cat').count == 3
+    assert t.contains('dog')
+    assert not t.contains('mouse')
+    assert [(a.key, a.count) for a in t.top_n(2)] == \
+        [('cat', 3), ('dog', 2)]
+
+    t.add_many(['mouse'] * 5 + ['cat'], list(range(6)))
+    assert [(a.key, a.count) for a in t.top_n(2)] == \
+        [('mouse', 5), ('cat', 4)]
+    assert t.get('mouse').data == 4
+
+    t.enable_stats()
+    t.add_many(['cat', 'cow', 'cow'])
+    stats = t.stats()
+    assert (stats['adds'], stats['hits'], stats['inserts'],
+            stats['rejections']) == (2, 1, 1, 0)
+    assert stats['tracked'] == 5
+
+    bench()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+import time
+
+
+clock = getattr(time, 'perf_counter', time.time)
+
+# Bucket i of a LatencyHistogram holds latencies below 2 ** i microseconds.
+NUM_BUCKETS = 32
+
+
+class LatencyHistogram(object):
+    """
+    Log2-bucketed latency histogram: recording is a few integer operations
+    and percentiles are accurate to within a factor of two.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        i = min(int(seconds * 1e6).bit_length(), NUM_BUCKETS - 1)
+        self.buckets[i] += 1
+
+    def percentile(self, p):
+        """
+        -> upper bound of the bucket holding the p-th latency, in seconds
+        """
+        if not self.count:
+            return 0.0
+        rank = p * self.count
+        seen = 0
+        for i, num in enumerate(self.buckets):
+            seen += num
+            if seen >= rank:
+                return min(float(1 << i) / 1e6, self.max)
+        return self.max
+
+    def snapshot(self):
+        """
+        -> dict of count, mean, p50, p99 and max (seconds)
+        """
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else 0.0,
+            'p50': self.percentile(0.5),
+            'p99': self.percentile(0.99),
+            'max': self.max,
+        }
+
+
+def timed(f, histogram):
+    """
+    Wrap f so every call's latency is recorded in histogram.
+    """
+    def wrapper(*args, **kwargs):
+        t0 = clock()
+        try:
+            return f(*args, **kwargs)
+        finally:
+            histogram.record(clock() - t0)
+    wrapper.__name__ = f.__name__
+    wrapper.__doc__ = f.__doc__
+    return wrapper
+
+
+def instrument(obj, method_names):
+    """
+    Shadow each named method of obj with a timed() instance attribute.  The
+    class is untouched, so objects that were never instrumented pay nothing.
+
+    -> {method name: LatencyHistogram}
+    """
+    latencies = {}
+    for name in method_names:
+        latencies[name] = LatencyHistogram()
+        setattr(obj, name, timed(getattr(obj, name), latencies[name]))
+    return latencies
+
+
+def uninstrument(obj, method_names):
+    for name in method_names:
+        obj.__dict__.pop(name, None)
+
+
+def snapshot_latencies(latencies):
+    """
+    {name: LatencyHistogram} -> {name: snapshot} for the names called so far
+    """
+    return dict((name, histogram.snapshot())
+                for name, histogram in latencies.items() if histogram.count)
@@ -1,5 +1,16 @@
 from redis import StrictRedis
 
+from cache import (
+    CACHE_ENTRIES, CACHE_TTL, ReadCache, cached, subscribe_invalidations)
+
+
+# Rows per page of iter_keys_counts(), to bound how long one command blocks
+# Redis.
+EXPORT_CHUNK = 1000
+
+# Reads answered from the client-side cache once it is enabled.
+CACHED_METHODS = ['get', 'contains', 'top_n_keys', 'top_n_keys_counts']
+
 
 class RedisTopTalkerTracker(object):
     def __init__(self, size=16384, redis_host='localhost', redis_port=6379,
@@ -7,15 +18,49 @@ class RedisTopTalkerTracker(object):
         self.size = size
         self.redis_table = 'top_talkers'
         self.client = StrictRedis(host=redis_host, port=redis_port)
+        self.cache = None
+        self.invalidator = None
 
         self.is_saturated = self.decide_is_saturated()
 
+    def enable_cache(self, max_entries=CACHE_ENTRIES, ttl=CACHE_TTL,
+                     invalidate=False):
+        """
+        Answer get(), contains(), top_n_keys() and top_n_keys_counts() from a
+        client-side cache.ReadCache of up to max_entries results, none older
+        than ttl seconds.  With invalidate=True keyspace notifications for
+        the table (notify-keyspace-events Kz on the server) drop them sooner.
+        """
+        if self.cache is not None:
+            return
+
+        self.cache = ReadCache(max_entries, ttl)
+        for name in CACHED_METHODS:
+            setattr(self, name, cached(getattr(self, name), self.cache, name,
+                                       lambda args: [self.redis_table]))
+        if invalidate:
+            self.invalidator = subscribe_invalidations(
+                self.client, self.cache, [self.redis_table])
+
+    def disable_cache(self):
+        if self.cache is None:
+            return
+
+        if self.invalidator is not None:
+            self.invalidator.stop()
+            self.invalidator = None
+        for name in CACHED_METHODS:
+            self.__dict__.pop(name, None)
+        self.cache = None
+
     def decide_is_saturated(self):
         return self.client.zcard(self.redis_table) >= self.size
 
     def clear(self):
         self.client.zremrangebyrank(self.redis_table, 0, -1)
         self.is_saturated = self.decide_is_saturated()
+        if self.cache is not None:
+            self.cache.invalidate()
 
     def is_full(self):
         if self.is_saturated:
@@ -35,26 +80,26 @@ class RedisTopTalkerTracker(object):
         count = self.client.zscore(self.redis_table, key)
         return count is not None
 
-    def add(self, key):
+    def add(self, key, weight=1):
         # If it's already in there, increment its count and we're done.
         count = self.client.zscore(self.redis_table, key)
         if count is not None:
-            self.client.zincrby(self.redis_table, key, 1)
+            self.client.zincrby(self.redis_table, key, weight)
             return
 
         # Else if the key is new to us but we're full, pop the lowest key/count
-        # pair and insert the new key as count + 1.
+        # pair and insert the new key as count + weight.
         if self.is_full():
             keys_counts = self.client.zrange(
                 self.redis_table, 0, 0, withscores=True, score_cast_func=int)
             old_count = keys_counts[0][1]
             self.client.zremrangebyrank(self.redis_table, 0, 0)
-            new_count = old_count + 1
+            new_count = old_count + weight
             self.client.zadd(self.redis_table, new_count, key)
             return
 
         # Or if the key is new to us and we have space, just insert it.
-        self.client.zadd(self.redis_table, 1, key)
+        self.client.zadd(self.redis_table, weight, key)
 
     def top_n_keys(self, n):
         return self.client.zrevrange(
@@ -71,6 +116,41 @@ class RedisTopTalkerTracker(object):
             the_min = 0
         return map(lambda (key, count): (key, count - the_min), keys_counts)
 
+    def iter_keys_counts(self, chunk_size=EXPORT_CHUNK, ordered=True):
+        """
+        Generator of (key, count) over the whole table, counts offset as by
+        top_n_keys_counts(), read chunk_size rows at a time so neither Redis
+        nor the client handles more than one page at once.
+
+        The min offset is read once, up front.  Pages go by rank, largest
+        first, so concurrent adds can repeat or skip a row; with
+        ordered=False the table is walked with ZSCAN instead, unordered, but
+        every key present for the whole export comes out at least once.
+        """
+        if self.is_full():
+            lowest_keys_counts = self.client.zrange(
+                self.redis_table, 0, 0, withscores=True, score_cast_func=int)
+            the_min = lowest_keys_counts[0][1] - 1
+        else:
+            the_min = 0
+
+        if not ordered:
+            for key, count in self.client.zscan_iter(
+                    self.redis_table, count=chunk_size, score_cast_func=int):
+                yield key, count - the_min
+            return
+
+        start = 0
+        while True:
+            keys_counts = self.client.zrevrange(
+                self.redis_table, start, start + chunk_size - 1,
+                withscores=True, score_cast_func=int)
+            for key, count in keys_counts:
+                yield key, count - the_min
+            if len(keys_counts) < chunk_size:
+                return
+            start += chunk_size
+
 
 def main():
     t = RedisTopTalkerTracker(size=4)
@@ -136,6 +216,36 @@ def main():
     assert t.top_n_keys(3) == ['goose', 'mouse', 'llama']
     assert t.top_n_keys_counts(3) == [('goose', 2), ('mouse', 1), ('llama', 1)]
 
+    t.clear()
+
+    t.add('cat', 5)
+    assert t.get('cat') == 5
+    t.add('dog', 2)
+    t.add('cat', 3)
+    assert t.get('cat') == 8
+    t.add('llama')
+    t.add('goose', 4)
+    assert t.is_full()
+    t.add('mouse', 10)
+    assert not t.contains('llama')
+    assert t.get('mouse') == 11
+    assert t.top_n_keys(3) == ['mouse', 'cat', 'goose']
+    assert t.top_n_keys_counts(3) == [('mouse', 10), ('cat', 7), ('goose', 3)]
+    assert list(t.iter_keys_counts(chunk_size=3)) == t.top_n_keys_counts(4)
+    assert sorted(t.iter_keys_counts(chunk_size=3, ordered=False)) == \
+        sorted(t.top_n_keys_counts(4))
+
+    t.enable_cache(ttl=60)
+    assert t.get('mouse') == 11
+    t.add('mouse')
+    assert t.get('mouse') == 11
+    assert t.top_n_keys(1) == ['mouse']
+    assert t.cache.stats()['hits'] == 1
+    t.clear()
+    assert t.get('mouse') is None
+    t.disable_cache()
+    assert 'get' not in t.__dict__
+
 
 if __name__ == '__main__':
     main()
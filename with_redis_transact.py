@@ -1,17 +1,117 @@
+from multiprocessing import Process, Queue
+import random
+import time
+
 from redis import StrictRedis
 
+from redis_lua import ERRORS_SUFFIX, LUA_ADD
+from stats import (
+    LatencyHistogram, clock, instrument, snapshot_latencies, uninstrument)
+
 
 LOCK_PREFIX = 'LOCK:'
 
 TIMEOUT = 10
 
+# How writes are made atomic:
+#   lock:   every call holds a distributed lock on the table (the original).
+#   watch:  add() retries WATCH/MULTI/EXEC until no other writer interfered.
+#   script: add() runs redis_lua's LUA_ADD, which Redis executes atomically.
+# Only lock mode takes a lock on reads.  Every mode keeps the table's errors
+# hash (see redis_lua.ERRORS_SUFFIX) as LUA_ADD does, on evictions only.
+MODE_LOCK = 'lock'
+MODE_WATCH = 'watch'
+MODE_SCRIPT = 'script'
+MODES = [MODE_LOCK, MODE_WATCH, MODE_SCRIPT]
+
+# Calls timed once stats are enabled.
+STATS_METHODS = ['clear', 'is_full', 'get', 'contains', 'add', 'top_n_keys',
+                 'top_n_keys_counts']
+
+
+class NoLock(object):
+    def acquire(self):
+        pass
+
+    def release(self):
+        pass
+
+
+class TimedLock(object):
+    """
+    Records how long each acquire() waited.
+    """
+
+    def __init__(self, lock, histogram):
+        self.lock = lock
+        self.histogram = histogram
+
+    def acquire(self):
+        t0 = clock()
+        r = self.lock.acquire()
+        self.histogram.record(clock() - t0)
+        return r
+
+    def release(self):
+        self.lock.release()
+
 
 class RedisTopTalkerTracker(object):
-    def __init__(self, redis_host='localhost', redis_port=6379):
+    def __init__(self, redis_host='localhost', redis_port=6379,
+                 mode=MODE_LOCK):
+        if mode not in MODES:
+            raise ValueError('Unknown mode: %r' % (mode,))
         self.client = StrictRedis(host=redis_host, port=redis_port)
+        self.mode = mode
         self.locks = {}
+        self.no_lock = NoLock()
+        self._add_script = self.client.register_script(LUA_ADD)
+        self.latencies = None
+        self.lock_wait = None
+
+    def enable_stats(self):
+        """
+        Start timing calls and, in lock mode, lock waits (see stats()).  The
+        timed methods are set on this instance only.
+        """
+        if self.latencies is not None:
+            return
+
+        self.latencies = instrument(self, STATS_METHODS)
+        self.lock_wait = lock_wait = LatencyHistogram()
+        get_lock = self.get_lock
+
+        def timed_get_lock(redis_table):
+            return TimedLock(get_lock(redis_table), lock_wait)
+
+        if self.mode == MODE_LOCK:
+            self.get_lock = timed_get_lock
+
+    def disable_stats(self):
+        uninstrument(self, STATS_METHODS + ['get_lock'])
+        self.latencies = None
+        self.lock_wait = None
+
+    def stats(self):
+        """
+        -> dict of per-method latency snapshots and the lock wait snapshot
+        (see stats.LatencyHistogram), empty unless stats are enabled
+
+        Each call's latency includes its lock wait, so a lock_wait close to
+        the add latency means writers are queueing on the lock, not on Redis.
+        """
+        if self.latencies is None:
+            return {}
+
+        return {
+            'latency': snapshot_latencies(self.latencies),
+            'lock_wait': self.lock_wait.snapshot(),
+        }
 
     def get_lock(self, redis_table):
+        if self.mode != MODE_LOCK:
+            return self.no_lock
+
         r = self.locks.get(redis_table)
         if r:
             return r
@@ -30,6 +130,7 @@ class RedisTopTalkerTracker(object):
         lock = self.get_lock(redis_table)
         lock.acquire()
         self.client.zremrangebyrank(redis_table, 0, -1)
+        self.client.delete(redis_table + ERRORS_SUFFIX)
         lock.release()
 
     def is_full(self, redis_table, redis_size):
@@ -66,34 +167,74 @@ class RedisTopTalkerTracker(object):
         lock.release()
         return count is not None
 
-    def add(self, redis_table, redis_size, key):
+    def add_watch(self, redis_table, redis_size, key, weight):
+        errors = redis_table + ERRORS_SUFFIX
+
+        def add(pipe):
+            count = pipe.zscore(redis_table, key)
+            if count is not None:
+                pipe.multi()
+                pipe.zincrby(redis_table, key, weight)
+                return
+
+            if pipe.zcard(redis_table) >= redis_size:
+                keys_counts = pipe.zrange(
+                    redis_table, 0, 0, withscores=True, score_cast_func=int)
+                old_key, old_count = keys_counts[0]
+                pipe.multi()
+                pipe.zremrangebyrank(redis_table, 0, 0)
+                pipe.hdel(errors, old_key)
+                pipe.zadd(redis_table, old_count + weight, key)
+                pipe.hset(errors, key, old_count)
+                return
+
+            pipe.multi()
+            pipe.zadd(redis_table, weight, key)
+
+        # Reruns add() whenever the table changed under our WATCH.
+        self.client.transaction(add, redis_table)
+
+    def add(self, redis_table, redis_size, key, weight=1):
         """
-        (table, size, key) -> None
+        (table, size, key, weight) -> None
         """
+        if self.mode == MODE_WATCH:
+            self.add_watch(redis_table, redis_size, key, weight)
+            return
+
+        if self.mode == MODE_SCRIPT:
+            self._add_script(keys=[redis_table, redis_size,
+                                   redis_table + ERRORS_SUFFIX, key, weight])
+            return
+
         lock = self.get_lock(redis_table)
         lock.acquire()
 
         # If it's already in there, increment its count and we're done.
         count = self.client.zscore(redis_table, key)
         if count is not None:
-            self.client.zincrby(redis_table, key, 1)
+            self.client.zincrby(redis_table, key, weight)
             lock.release()
             return
 
         # Else if the key is new to us but we're full, pop the lowest key/count
-        # pair and insert the new key as count + 1.
+        # pair and insert the new key as count + weight, with the count it
+        # took over as its error.
         if self.is_full_inner(redis_table, redis_size):
+            errors = redis_table + ERRORS_SUFFIX
             keys_counts = self.client.zrange(
                 redis_table, 0, 0, withscores=True, score_cast_func=int)
-            old_count = keys_counts[0][1]
+            old_key, old_count = keys_counts[0]
             self.client.zremrangebyrank(redis_table, 0, 0)
-            new_count = old_count + 1
+            self.client.hdel(errors, old_key)
+            new_count = old_count + weight
             self.client.zadd(redis_table, new_count, key)
+            self.client.hset(errors, key, old_count)
             lock.release()
             return
 
         # Or if the key is new to us and we have space, just insert it.
-        self.client.zadd(redis_table, 1, key)
+        self.client.zadd(redis_table, weight, key)
         lock.release()
 
     def top_n_keys(self, redis_table, n):
@@ -111,6 +252,9 @@ class RedisTopTalkerTracker(object):
         """
         (table, size, n) -> list of (key, count)
         """
+        if self.mode != MODE_LOCK:
+            return self.top_n_keys_counts_transact(redis_table, redis_size, n)
+
         lock = self.get_lock(redis_table)
         lock.acquire()
         keys_counts = self.client.zrevrange(
@@ -124,13 +268,28 @@ class RedisTopTalkerTracker(object):
         lock.release()
         return map(lambda (key, count): (key, count - the_min), keys_counts)
 
+    def top_n_keys_counts_transact(self, redis_table, redis_size, n):
+        """
+        Read the top n and the minimum in one MULTI/EXEC, which is consistent
+        without a lock.
+        """
+        pipe = self.client.pipeline(transaction=True)
+        pipe.zrevrange(
+            redis_table, 0, n - 1, withscores=True, score_cast_func=int)
+        pipe.zcard(redis_table)
+        pipe.zrange(redis_table, 0, 0, withscores=True, score_cast_func=int)
+        keys_counts, count, lowest_keys_counts = pipe.execute()
+        if count >= redis_size:
+            the_min = lowest_keys_counts[0][1] - 1
+        else:
+            the_min = 0
+        return map(lambda (key, count): (key, count - the_min), keys_counts)
 
-def main():
+
+def check_tracker(t):
     redis_table = 'top_talkers'
     redis_size = 4
 
-    t = RedisTopTalkerTracker()
-
     t.clear(redis_table)
 
     assert not t.is_full(redis_table, redis_size)
@@ -194,6 +353,91 @@ def main():
 
     t.clear(redis_table)
 
+    t.add(redis_table, redis_size, 'cat', 5)
+    assert t.get(redis_table, 'cat') == 5
+    t.add(redis_table, redis_size, 'dog', 2)
+    t.add(redis_table, redis_size, 'cat', 3)
+    assert t.get(redis_table, 'cat') == 8
+    t.add(redis_table, redis_size, 'llama')
+    t.add(redis_table, redis_size, 'goose', 4)
+    assert t.is_full(redis_table, redis_size)
+    t.add(redis_table, redis_size, 'mouse', 10)
+    assert not t.contains(redis_table, 'llama')
+    assert t.get(redis_table, 'mouse') == 11
+    assert t.client.hgetall(redis_table + ERRORS_SUFFIX) == {'mouse': '1'}
+    assert t.top_n_keys(redis_table, 3) == ['mouse', 'cat', 'goose']
+    assert t.top_n_keys_counts(redis_table, redis_size, 3) == [('mouse', 10), ('cat', 7), ('goose', 3)]
+
+    t.clear(redis_table)
+
+
+def run_writer(mode, redis_table, redis_size, num_adds, seed, queue):
+    t = RedisTopTalkerTracker(mode=mode)
+    rng = random.Random(seed)
+    keys = map(lambda i: str(int(rng.paretovariate(1.1))), range(num_adds))
+    t0 = time.time()
+    for key in keys:
+        t.add(redis_table, redis_size, key)
+    queue.put(time.time() - t0)
+
+
+def bench(redis_size=16384, adds_per_writer=5000,
+          writer_counts=(1, 2, 4, 8)):
+    """
+    Print aggregate add() throughput for N concurrent writer processes
+    hammering one table, per mode.  Needs a local redis-server.
+    """
+    redis_table = 'top_talkers_bench'
+    print '%8s %8s %12s' % ('mode', 'writers', 'adds/s')
+    for mode in MODES:
+        for num_writers in writer_counts:
+            t = RedisTopTalkerTracker(mode=mode)
+            t.clear(redis_table)
+            queue = Queue()
+            writers = map(lambda i: Process(
+                target=run_writer, args=(mode, redis_table, redis_size,
+                                         adds_per_writer, i, queue)),
+                range(num_writers))
+            for writer in writers:
+                writer.start()
+            elapsed = max(map(lambda writer: queue.get(), writers))
+            for writer in writers:
+                writer.join()
+            rate = num_writers * adds_per_writer / elapsed
+            print '%8s %8d %12d' % (mode, num_writers, rate)
+            t.clear(redis_table)
+
+
+def check_stats(mode):
+    redis_table = 'top_talkers'
+    t = RedisTopTalkerTracker(mode=mode)
+    t.clear(redis_table)
+    assert t.stats() == {}
+
+    t.enable_stats()
+    for key in ['cat', 'dog', 'cat']:
+        t.add(redis_table, 4, key)
+    assert t.get(redis_table, 'cat') == 2
+    stats = t.stats()
+    assert stats['latency']['add']['count'] == 3
+    assert stats['latency']['get']['count'] == 1
+    if mode == MODE_LOCK:
+        assert stats['lock_wait']['count'] == 4
+    else:
+        assert stats['lock_wait']['count'] == 0
+
+    t.disable_stats()
+    t.clear(redis_table)
+    assert t.stats() == {}
+
+
+def main():
+    for mode in MODES:
+        check_tracker(RedisTopTalkerTracker(mode=mode))
+        check_stats(mode)
+
+    bench()
+
 
 if __name__ == '__main__':
     main()